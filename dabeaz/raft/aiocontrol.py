@@ -0,0 +1,110 @@
+# aiocontrol.py
+#
+# A Raft controller that runs on an asyncio event loop instead of
+# threads.  The machine is the same.  Events and the receiver are tasks
+# and the timers are loop timers, all on one loop, so any number of
+# servers can share a process (see main() below).
+#
+# The loop usually runs in a background thread (start_loop()) so that
+# threaded code like KVServer can keep calling append_entry().
+
+import asyncio
+import threading
+
+from .control import RaftController
+from .aiodispatcher import AsyncQueueDispatcher
+from .machine import RaftMachine
+from .config import *
+
+def start_loop():
+    # An event loop running in a daemon thread
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+class AsyncRaftController(RaftController):
+    def __init__(self, addr, dispatcher, machine, loop, **kwargs):
+        super().__init__(addr, dispatcher, machine, **kwargs)
+        self.loop = loop
+        self.event_queue = asyncio.Queue()
+        self._tasks = [ ]
+
+    # The main event loop.  Can be called from any thread
+    def start(self):
+        self.running = True
+        print(f"Starting server: {self.addr}")
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop)
+
+    async def _start(self):
+        self.reset_leader_timeout()
+        self.reset_election_timer()
+        self._tasks = [ asyncio.create_task(self.run()), asyncio.create_task(self.run_receiver()) ]
+
+    def stop(self):
+        self.running = False
+        for task in self._tasks:
+            self.loop.call_soon_threadsafe(task.cancel)
+        for timer in [ self._leader_timer, self._election_timer ]:
+            if timer:
+                self.loop.call_soon_threadsafe(timer.cancel)
+
+    # Used by the client functions (append_entry(), read_index()).  Their
+    # results are concurrent.futures.Futures.  Use asyncio.wrap_future()
+    # to await them.
+    def post(self, event):
+        # Add an event to the queue from any thread
+        self.loop.call_soon_threadsafe(self.event_queue.put_nowait, event)
+
+    async def run(self):
+        while self.running:
+            self.handle_event(await self.event_queue.get())
+            await self.run_batch()
+            self.check_waiters()
+            await self.sync()
+            self.flush_messages()
+
+    async def run_batch(self):
+        window = self.machine.storage.commit_window
+        deadline = self.loop.time() + window
+        for _ in range(MAX_EVENT_BATCH):
+            if self.event_queue.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    return
+                try:
+                    evt = await asyncio.wait_for(self.event_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    return
+            else:
+                evt = self.event_queue.get_nowait()
+            self.handle_event(evt)
+
+    async def sync(self):
+        # With group commit, the fsync runs in a worker thread so that
+        # other servers on the loop keep going.  Our messages still wait.
+        if self.machine.storage.commit_window:
+            await self.loop.run_in_executor(None, self.machine.storage.sync)
+        else:
+            self.machine.storage.sync()
+
+    async def run_receiver(self):
+        while self.running:
+            msg = await self.dispatcher.recv_message(self.addr)
+            self.event_queue.put_nowait(('handle_Message', msg))
+
+    # Timers are loop timers (see RaftController.call_later)
+    def call_later(self, delay, event):
+        return self.loop.call_later(delay, self.event_queue.put_nowait, event)
+
+def main():
+    # Whole cluster on one event loop
+    loop = start_loop()
+    dispatch = AsyncQueueDispatcher(NSERVERS)
+    controllers = [ AsyncRaftController(i, dispatch, RaftMachine(), loop)
+                    for i in range(NSERVERS) ]
+    for cont in controllers:
+        cont.start()
+    return controllers
+
+if __name__ == '__main__':
+    servers = main()
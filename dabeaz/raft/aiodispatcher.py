@@ -0,0 +1,153 @@
+# aiodispatcher.py
+#
+# Dispatchers for the asyncio runtime (see aiocontrol.py).  Same idea as
+# dispatcher.py, but recv_message() is a coroutine and everything runs on
+# one event loop.  send_message() must be called from the loop.
+
+import asyncio
+import collections
+
+from . import codec
+from .dispatcher import is_bulk, reconnect_delay, SendQueue
+from .channel import header_size, pack_header, unpack_header
+from .channel import Compression, compression_offer, choose_compression
+from .config import *
+
+class AsyncQueueDispatcher:
+    # All servers in the same process (and on the same event loop)
+    def __init__(self, nservers):
+        self.nservers = nservers
+        self.channels = [ asyncio.Queue() for n in range(nservers) ]
+        self.counts = collections.Counter()     # Messages sent, by type
+
+    def start(self):
+        pass
+
+    def send_message(self, msg):
+        self.counts[type(msg).__name__] += 1
+        self.channels[msg.dest].put_nowait(msg)
+
+    async def recv_message(self, addr):
+        return await self.channels[addr].get()
+
+# Messages are framed the same way as Channel (same size header) so the
+# two runtimes can talk to each other.
+
+class AsyncSendQueue(SendQueue):
+    # SendQueue (see dispatcher.py) for tasks on the event loop
+    def __init__(self, maxsize=DISPATCH_QUEUE_SIZE):
+        super().__init__(maxsize)
+        self._ready = asyncio.Event()
+
+    def put(self, msg):
+        super().put(msg)
+        self._ready.set()
+
+    async def get(self, n):
+        while not self.messages:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.take(n)
+
+async def recv_frame(reader, compression=None):
+    size, compressed = unpack_header(await reader.readexactly(header_size()))
+    msg = await reader.readexactly(size)
+    if compressed:
+        if compression is None:
+            raise OSError('Compressed message without compression')
+        return compression.decompress(msg)
+    return msg
+
+def send_frame(writer, msg, compression=None):
+    compressed = False
+    if compression:
+        msg, compressed = compression.compress(msg)
+    writer.writelines([ pack_header(len(msg), compressed=compressed), msg ])
+
+class AsyncChannelDispatcher:
+    def __init__(self, addr, loop):
+        self.addr = addr
+        self.loop = loop
+        self.nservers = len(RAFT_SERVER_CONFIG)
+        self._recv_queue = asyncio.Queue()
+        self._send_queues = [ AsyncSendQueue() for n in range(self.nservers) ]
+        self._bulk_queues = [ AsyncSendQueue() for n in range(self.nservers) ]   # See dispatcher.py
+        self._tasks = [ ]
+        # Compression (see channel.py) of the messages sent to each server
+        self.compression_stats = [ collections.Counter() for n in range(self.nservers) ]
+
+    def compression_ratios(self):
+        return { addr: stats['compressed_bytes'] / stats['bytes']
+                 for addr, stats in enumerate(self.compression_stats) if stats['bytes'] }
+
+    def link_stats(self):
+        # Same as ChannelDispatcher.link_stats()
+        return { addr: { 'control': self._send_queues[addr].summary(),
+                         'bulk': self._bulk_queues[addr].summary() }
+                 for addr in range(self.nservers) if addr != self.addr }
+
+    def start(self):
+        # Can be called from any thread
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop)
+
+    async def _start(self):
+        host, port = RAFT_SERVER_CONFIG[self.addr]
+        self._server = await asyncio.start_server(self.raft_receiver, host, port, reuse_address=True)
+        for n in range(self.nservers):
+            if n != self.addr:
+                for queue in [ self._send_queues[n], self._bulk_queues[n] ]:
+                    self._tasks.append(asyncio.create_task(self.raft_sender(n, queue)))
+
+    async def recv_message(self, addr):
+        assert addr == self.addr
+        return await self._recv_queue.get()
+
+    def send_message(self, msg):
+        (self._bulk_queues if is_bulk(msg) else self._send_queues)[msg.dest].put(msg)
+
+    # Task that reads messages from another server
+    async def raft_receiver(self, reader, writer):
+        try:
+            name = choose_compression(await recv_frame(reader))
+            send_frame(writer, name.encode())
+            compression = Compression(name)
+            while True:
+                self._recv_queue.put_nowait(codec.decode(await recv_frame(reader, compression)))
+        except codec.CodecError as e:
+            # Drop the connection to a peer sending garbage
+            print(f'Server {self.addr}: {e}')
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Task that sends messages to a destination server.  As with the
+    # threaded dispatcher, messages that can't be sent go back on the
+    # queue and the connection is retried after a backoff.
+    async def raft_sender(self, addr, queue):
+        writer = None
+        failures = 0
+        while True:
+            # Write everything queued up before waiting on the socket
+            msgs = await queue.get(DISPATCH_MAX_BATCH)
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(*RAFT_SERVER_CONFIG[addr]),
+                                                            DISPATCH_CONNECT_TIMEOUT)
+                    send_frame(writer, compression_offer())
+                    compression = Compression(bytes(await recv_frame(reader)).decode(),
+                                              stats=self.compression_stats[addr])
+                    queue.stats['connects'] += 1
+                for msg in msgs:
+                    send_frame(writer, codec.encode(msg), compression)
+                await writer.drain()
+                queue.stats['sent'] += len(msgs)
+                failures = 0
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if writer:
+                    writer.close()
+                writer = None
+                queue.requeue(msgs)
+                queue.stats['failures'] += 1
+                failures += 1
+                await asyncio.sleep(reconnect_delay(failures))
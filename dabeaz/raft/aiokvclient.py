@@ -0,0 +1,223 @@
+# aiokvclient.py
+#
+# asyncio version of KVClient (see kvclient.py).  Requests use the
+# pipelined protocol, (id, name, args) answered by (id, status, result),
+# so any number of them can share a connection.  The client keeps a small
+# pool of connections to each server it talks to and spreads requests
+# over them.
+#
+# Commands go to the leader.  Servers that aren't the leader redirect
+# them, and a lost connection sends them to the next server to try, as
+# with KVClient.  Gets with bounds can go to read_servers instead (any
+# server can answer them).  Every request has a timeout.  Writes are
+# made in a session, so retrying them is safe (as with KVClient).
+#
+#     client = AsyncKVClient(read_servers=[1, 2])
+#     await client.set('x', 42)
+#     await client.get('x')
+#     await client.get('x', min_index=client.last_index)
+
+import asyncio
+import itertools
+import pickle
+import random
+import uuid
+
+from .aiodispatcher import recv_frame, send_frame
+from .kvclient import KVError, WRITES
+from .config import *
+
+class _Redirect(Exception):
+    # Not the leader.  args[0] is the leader it knows of (or None)
+    pass
+
+class _Connection:
+    def __init__(self, pool, reader, writer):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.pending = { }        # Request id -> Future
+        self.closed = False
+        self.task = asyncio.create_task(self.read_responses())
+
+    @classmethod
+    async def open(cls, pool, n):
+        reader, writer = await asyncio.open_connection(*KV_SERVER_CONFIG[n])
+        try:
+            await recv_frame(reader)      # 'ok' or ('follower', leader)
+        except asyncio.IncompleteReadError as e:
+            writer.close()
+            raise ConnectionError(f'Server {n} closed the connection') from e
+        return cls(pool, reader, writer)
+
+    async def request(self, req_id, name, args, session):
+        if self.closed:
+            raise ConnectionError('Connection closed')
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = fut
+        try:
+            request = (req_id, name, args, session) if session else (req_id, name, args)
+            send_frame(self.writer, pickle.dumps(request))
+            await self.writer.drain()
+            return await fut
+        finally:
+            self.pending.pop(req_id, None)
+
+    async def read_responses(self):
+        try:
+            while True:
+                req_id, status, result = pickle.loads(await recv_frame(self.reader))
+                fut = self.pending.get(req_id)
+                if fut is None or fut.done():
+                    continue          # Timed out
+                if status == 'ok':
+                    fut.set_result(result)
+                elif status == 'redirect':
+                    fut.set_exception(_Redirect(result))
+                else:
+                    fut.set_exception(KVError(result))
+        except (OSError, ValueError, asyncio.IncompleteReadError, pickle.UnpicklingError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self in self.pool:
+            self.pool.remove(self)
+        self.writer.close()
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError('Connection lost'))
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+class AsyncKVClient:
+    def __init__(self, read_servers=(), pool_size=KV_POOL_SIZE, timeout=KV_REQUEST_TIMEOUT):
+        self.read_servers = list(read_servers)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.leader = None         # Last known leader
+        self.last_index = -1       # Log index of the last set
+        self._pools = { }          # Server -> [ _Connection ]
+        self._locks = { }          # Server -> asyncio.Lock (for opening connections)
+        self._ids = itertools.count()
+        self._rr = itertools.count()
+        self.client_id = uuid.uuid4().hex
+        self._seqs = itertools.count(1)
+        self._unanswered = set()   # Sequence numbers of writes in progress
+        self._acked = 0            # Every write up to here has been answered
+
+    async def _connection(self, n):
+        # A connection to server n.  New connections are opened one at a
+        # time until there are pool_size of them.
+        pool = self._pools.setdefault(n, [ ])
+        lock = self._locks.setdefault(n, asyncio.Lock())
+        while not pool or (len(pool) < self.pool_size and not lock.locked()):
+            async with lock:
+                if len(pool) < self.pool_size:
+                    conn = await _Connection.open(pool, n)
+                    pool.append(conn)
+                    return conn
+        return pool[next(self._rr) % len(pool)]
+
+    async def _request(self, n, name, args, session=None):
+        conn = await self._connection(n)
+        return await conn.request(next(self._ids), name, args, session)
+
+    async def _leader_command(self, name, args, session=None):
+        # Find the leader the same way KVClient does.  Start with the last
+        # known one and follow redirects.  After trying every server, wait
+        # (randomized, doubling) and start over.
+        backoff = KV_CONNECT_BACKOFF
+        tried = set()
+        n = self.leader
+        while True:
+            if n is None or n in tried:
+                untried = [ i for i in range(len(KV_SERVER_CONFIG)) if i not in tried ]
+                if not untried:
+                    self.leader = None
+                    await asyncio.sleep(backoff * (0.5 + random.random()))
+                    backoff = min(backoff * 2, KV_CONNECT_BACKOFF_MAX)
+                    tried.clear()
+                    continue
+                n = untried[0]
+            try:
+                result = await self._request(n, name, args, session)
+                self.leader = n
+                return result
+            except _Redirect as e:
+                tried.add(n)
+                n = e.args[0]
+            except OSError:
+                tried.add(n)
+                n = None
+
+    async def _read_command(self, name, args):
+        # Try the read servers in turn.  The leader if none answer
+        start = next(self._rr)
+        for i in range(len(self.read_servers)):
+            n = self.read_servers[(start + i) % len(self.read_servers)]
+            try:
+                return await self._request(n, name, args)
+            except OSError:
+                pass
+        return await self._leader_command(name, args)
+
+    async def command(self, name, *args, timeout=None):
+        session = None
+        if name in WRITES:
+            seq = next(self._seqs)
+            self._unanswered.add(seq)
+            while self._acked + 1 not in self._unanswered:
+                self._acked += 1
+            session = (self.client_id, seq, self._acked)
+        # Like KVClient, a write is only forgotten once it's answered.  One
+        # that times out or fails may still be applied
+        try:
+            result = await asyncio.wait_for(self._leader_command(name, args, session),
+                                            self.timeout if timeout is None else timeout)
+        except KVError:
+            if session:
+                self._unanswered.discard(seq)
+            raise
+        if session:
+            self._unanswered.discard(seq)
+        return result
+
+    async def get(self, key, min_index=None, max_staleness=None, timeout=None):
+        # Same as KVClient.get()
+        if min_index is None and max_staleness is None:
+            return await self.command('get', key, timeout=timeout)
+        return await asyncio.wait_for(self._read_command('get', (key, min_index, max_staleness)),
+                                      self.timeout if timeout is None else timeout)
+
+    async def set(self, key, value, timeout=None):
+        # Returns the log index of the write
+        return self._note_index(await self.command('set', key, value, timeout=timeout))
+
+    # Same as KVClient.mget(), mset() and mdelete()
+    async def mget(self, keys, min_index=None, max_staleness=None, timeout=None):
+        keys = list(keys)
+        if min_index is None and max_staleness is None:
+            return await self.command('mget', keys, timeout=timeout)
+        return await asyncio.wait_for(self._read_command('mget', (keys, min_index, max_staleness)),
+                                      self.timeout if timeout is None else timeout)
+
+    async def mset(self, items, timeout=None):
+        items = list(items.items() if isinstance(items, dict) else items)
+        return self._note_index(await self.command('mset', items, timeout=timeout))
+
+    async def mdelete(self, keys, timeout=None):
+        return self._note_index(await self.command('mdelete', list(keys), timeout=timeout))
+
+    def _note_index(self, index):
+        self.last_index = max(self.last_index, index)
+        return index
+
+    def close(self):
+        for pool in self._pools.values():
+            for conn in list(pool):
+                conn.close()
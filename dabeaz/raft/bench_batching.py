@@ -0,0 +1,55 @@
+# bench_batching.py
+#
+# Effect of leader-side entry batching on message counts and throughput.
+# Runs a cluster in-process on a QueueDispatcher with clients writing as
+# fast as they can, once for each batch delay setting.
+#
+#    python -m dabeaz.raft.bench_batching [delay_us ...]
+
+import sys
+import threading
+import time
+
+from .config import NSERVERS
+from .control import RaftController
+from .dispatcher import QueueDispatcher
+from .machine import RaftMachine, Leader
+
+def run(delay, nclients=16, nwrites=200, batch_entries=100):
+    dispatch = QueueDispatcher(NSERVERS)
+    controllers = [ RaftController(i, dispatch, RaftMachine()) for i in range(NSERVERS) ]
+    for cont in controllers:
+        cont.machine.batchDelay = delay / 1e6
+        cont.machine.batchEntries = batch_entries
+        cont.start()
+
+    while not any(cont.machine.state is Leader for cont in controllers):
+        time.sleep(0.1)
+    leader = next(cont for cont in controllers if cont.machine.state is Leader)
+
+    def client(n):
+        for i in range(nwrites):
+            leader.append_entry((n, i)).result()
+
+    dispatch.counts.clear()
+    start = time.perf_counter()
+    threads = [ threading.Thread(target=client, args=(n,)) for n in range(nclients) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    for cont in controllers:
+        cont.running = False
+    total = nclients * nwrites
+    return total / elapsed, dispatch.counts['AppendEntries'] / total
+
+def main(delays=(0, 200, 1000, 5000)):
+    print(f'{"delay us":>9} {"writes/s":>10} {"appends/write":>14}')
+    for delay in delays:
+        rate, per_write = run(delay)
+        print(f'{delay:>9} {rate:>10.0f} {per_write:>14.2f}')
+
+if __name__ == '__main__':
+    main([ int(arg) for arg in sys.argv[1:] ] or (0, 200, 1000, 5000))
@@ -0,0 +1,64 @@
+# bench_channel.py
+#
+# Channel throughput over a socketpair, against the original Channel
+# (two sendall() calls per message and recv_exactly() building each
+# message with +=).
+#
+#    python -m dabeaz.raft.bench_channel
+
+import socket
+import threading
+import time
+
+from .channel import Channel
+
+class OriginalChannel:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, msg):
+        self.sock.sendall(b'%12d' % len(msg))
+        self.sock.sendall(msg)
+
+    def recv_exactly(self, nbytes):
+        msg = b''
+        while len(msg) < nbytes:
+            fragment = self.sock.recv(nbytes-len(msg))
+            if not fragment:
+                raise OSError("Incomplete message")
+            msg += fragment
+        return msg
+
+    def recv(self):
+        return self.recv_exactly(int(self.recv_exactly(12)))
+
+def run(make_channel, size, count):
+    s1, s2 = socket.socketpair()
+    sender, receiver = make_channel(s1), make_channel(s2)
+    msg = b'x' * size
+    def send():
+        for _ in range(count):
+            sender.send(msg)
+    start = time.perf_counter()
+    thread = threading.Thread(target=send)
+    thread.start()
+    for _ in range(count):
+        receiver.recv()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    s1.close()
+    s2.close()
+    return count / elapsed, count * size / elapsed / 1e6
+
+def main():
+    channels = [ ('original', OriginalChannel),
+                 ('buffered', Channel),
+                 ('binary', lambda sock: Channel(sock, binary_header=True)) ]
+    print(f'{"size":>9} {"channel":>9} {"msgs/s":>10} {"MB/s":>8}')
+    for size, count in [ (100, 100000), (10000, 20000), (1000000, 200), (10000000, 10) ]:
+        for name, make_channel in channels:
+            rate, mbytes = run(make_channel, size, count)
+            print(f'{size:>9} {name:>9} {rate:>10.0f} {mbytes:>8.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# bench_codec.py
+#
+# Microbenchmark of the binary wire codec against pickle.
+#
+#    python -m dabeaz.raft.bench_codec
+
+import pickle
+import time
+
+from . import codec
+from .machine import LogEntry
+from .message import AppendEntries, AppendEntriesResponse, RequestVote, RequestVoteResponse
+
+def sample_messages():
+    return {
+        'heartbeat': AppendEntries(source=0, dest=1, term=12, prevLogIndex=10432, prevLogTerm=12,
+                                   entries=[], leaderCommit=10431),
+        'append(100)': AppendEntries(source=0, dest=1, term=12, prevLogIndex=10432, prevLogTerm=12,
+                                     entries=[ LogEntry(12, (f'key{n}', f'value{n}')) for n in range(100) ],
+                                     leaderCommit=10431),
+        'append-response': AppendEntriesResponse(source=1, dest=0, term=12, success=True, matchIndex=10532),
+        'request-vote': RequestVote(source=2, dest=0, term=13, lastLogIndex=10532, lastLogTerm=12),
+        'vote-response': RequestVoteResponse(source=0, dest=2, term=13, voteGranted=True),
+    }
+
+def encode_fresh(msg):
+    # Entries cache their encoded payload.  Clear it so that the
+    # encoding is timed, not the cache
+    if type(msg) is AppendEntries:
+        for e in msg.entries:
+            e._payload = None
+    return codec.encode(msg)
+
+def timeit(func, arg, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func(arg)
+    return (time.perf_counter() - start) / n
+
+def main(n=20000):
+    print(f'{"message":<16} {"codec":>8} {"bytes":>7} {"encode us":>10} {"decode us":>10}')
+    for name, msg in sample_messages().items():
+        count = n if msg.__class__ is not AppendEntries or not msg.entries else n // 50
+        for label, dumps, loads in [('pickle', pickle.dumps, pickle.loads),
+                                    ('binary', encode_fresh, codec.decode)]:
+            data = dumps(msg)
+            enc = timeit(dumps, msg, count)
+            dec = timeit(loads, data, count)
+            print(f'{name:<16} {label:>8} {len(data):>7} {enc*1e6:>10.2f} {dec*1e6:>10.2f}')
+
+if __name__ == '__main__':
+    main()
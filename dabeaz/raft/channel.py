@@ -1,38 +1,226 @@
-# message.py
+# channel.py
+
+import collections
+import lzma
+import struct
+import zlib
+
+from .config import (CHANNEL_BINARY_HEADER, CHANNEL_BUFFER_SIZE, CHANNEL_MAX_MESSAGE,
+                     CHANNEL_COMPRESSION, CHANNEL_COMPRESS_THRESHOLD)
+
+# Size headers.  12 ASCII digits (the original format) or, if
+# CHANNEL_BINARY_HEADER is set, a 4 byte unsigned int.  Compressed
+# messages have a negative size (text) or the top bit set (binary).
+_binary_header = struct.Struct('>I')
+_COMPRESSED_BIT = 0x80000000
+
+# Messages up to this size are sent joined to their header
+_SMALL_MESSAGE = 16384
+
+# Most buffers passed to one sendmsg() (IOV_MAX is usually 1024)
+_MAX_BUFFERS = 1024
+
+def header_size(binary=CHANNEL_BINARY_HEADER):
+    return _binary_header.size if binary else 12
+
+def pack_header(size, binary=CHANNEL_BINARY_HEADER, compressed=False):
+    if binary:
+        return _binary_header.pack(size | _COMPRESSED_BIT if compressed else size)
+    sz = b'%12d' % (-size if compressed else size)
+    assert len(sz) == 12, "Whoa!"
+    return sz
+
+def unpack_header(header, binary=CHANNEL_BINARY_HEADER):
+    # Returns (size, compressed)
+    if binary:
+        sz = _binary_header.unpack(header)[0]
+        return check_size(sz & ~_COMPRESSED_BIT), bool(sz & _COMPRESSED_BIT)
+    sz = int(header)
+    return check_size(abs(sz)), sz < 0
+
+def check_size(size):
+    if size > CHANNEL_MAX_MESSAGE:
+        raise OSError(f'Message too big ({size} bytes)')
+    return size
+
+# Compression.  The side that connects offers the compressors it can
+# use (CHANNEL_COMPRESSION, in order of preference) in its first message.
+# The other side answers with the first one it also has, or nothing.
+# Only messages of at least CHANNEL_COMPRESS_THRESHOLD bytes that get
+# smaller are compressed, so small messages (heartbeats) are sent as is.
+# Others can be added with register_compressor().  Decompressors are
+# called with (data, max_size) and raise OSError for data that doesn't
+# decompress to at most max_size bytes.  A small message from a peer
+# must not be able to expand without bound.
+def _bounded(decompressor, errors):
+    def decompress(data, max_size):
+        d = decompressor()
+        try:
+            msg = d.decompress(data, max_size + 1)
+        except errors as e:
+            raise OSError(f'Bad compressed message: {e}') from None
+        if len(msg) > max_size:
+            raise OSError('Decompressed message too big')
+        if not d.eof:
+            raise OSError('Truncated compressed message')
+        return msg
+    return decompress
+
+_compressors = {
+    'zlib': (lambda data: zlib.compress(data, 1), _bounded(zlib.decompressobj, zlib.error)),
+    'lzma': (lzma.compress, _bounded(lzma.LZMADecompressor, lzma.LZMAError)),
+}
+
+def register_compressor(name, compress, decompress):
+    _compressors[name] = (compress, decompress)
+
+def compression_offer(names=CHANNEL_COMPRESSION):
+    return b'compress:' + ','.join(name for name in names if name in _compressors).encode()
+
+def choose_compression(offer, names=CHANNEL_COMPRESSION):
+    # Answer to an offer (a name, or '' for no compression)
+    if not offer.startswith(b'compress:'):
+        raise OSError('Expected a compression offer')
+    offered = bytes(offer[9:]).decode().split(',')
+    return next((name for name in offered if name in names and name in _compressors), '')
+
+class Compression:
+    # Compression used on one connection.  stats counts the messages
+    # that were compressed, their size and their compressed size.
+    def __init__(self, name='', threshold=CHANNEL_COMPRESS_THRESHOLD, stats=None):
+        self.name = name
+        self.threshold = threshold
+        self.stats = stats if stats is not None else collections.Counter()
+        self._compress, self._decompress = _compressors[name] if name else (None, None)
+
+    def compress(self, msg):
+        # Returns (payload, compressed)
+        if self._compress and len(msg) >= self.threshold:
+            data = self._compress(msg)
+            if len(data) < len(msg):
+                self.stats['messages'] += 1
+                self.stats['bytes'] += len(msg)
+                self.stats['compressed_bytes'] += len(data)
+                return data, True
+        return msg, False
+
+    def decompress(self, data, max_size=CHANNEL_MAX_MESSAGE):
+        if not self._decompress:
+            raise OSError('Compressed message without compression')
+        return self._decompress(data, max_size)
 
 class Channel:
-    def __init__(self, sock):
+    # Received data goes into a buffer with recv_into().  One recv can
+    # bring in many small messages (or the start of the next one), which
+    # recv() then hands out without going back to the socket.  Messages
+    # bigger than the buffer are received directly into a bytearray of
+    # their own size.  Sends put the header and the message in one call
+    # (joined if the message is small, sendmsg() otherwise), which also
+    # keeps Nagle's algorithm from holding back the message.
+    def __init__(self, sock, binary_header=CHANNEL_BINARY_HEADER, bufsize=CHANNEL_BUFFER_SIZE):
         self.sock = sock   # An already existing socket object
-                           # What it be better to create the 
-                           # socket in here and hide implementation details?
+        self.binary_header = binary_header
+        self.compression = Compression()
+        self._header_size = header_size(binary_header)
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0     # Unread data is _buf[_start:_end]
+
+    # Compression negotiation.  Called once, first thing, by each side
+    def offer_compression(self, names=CHANNEL_COMPRESSION, stats=None):
+        self.send(compression_offer(names))
+        self.compression = Compression(bytes(self.recv()).decode(), stats=stats)
+
+    def accept_compression(self, names=CHANNEL_COMPRESSION, stats=None):
+        name = choose_compression(self.recv(), names)
+        self.send(name.encode())
+        self.compression = Compression(name, stats=stats)
+
+    def _frame(self, msg):
+        msg, compressed = self.compression.compress(msg)
+        return pack_header(len(msg), self.binary_header, compressed), msg
 
     def send(self, msg: bytes):
-        # Send len(msg)
-        # How to encode the size header????
-        #   - Binary integer (32-bit unsigned int? byte-order?)
-        #   - Text? (length embedded in a 12-character field)
-        sz = b'%12d' % (len(msg))
-        assert len(sz) == 12, "Whoa!"
-        self.sock.sendall(sz)
-        self.sock.sendall(msg)
+        header, msg = self._frame(msg)
+        if len(msg) <= _SMALL_MESSAGE:
+            self.sock.sendall(header + msg)    # Copying is cheaper
+        else:
+            self._sendall([ header, msg ])
+
+    def send_many(self, msgs):
+        # Send several messages with one write.  The receiver gets them
+        # one at a time with recv() as usual
+        buffers = [ ]
+        for msg in msgs:
+            buffers.extend(self._frame(msg))
+        if sum(len(buf) for buf in buffers) <= _SMALL_MESSAGE:
+            self.sock.sendall(b''.join(buffers))
+        else:
+            self._sendall(buffers)
+
+    def _sendall(self, buffers):
+        if not hasattr(self.sock, 'sendmsg'):
+            # Windows
+            self.sock.sendall(b''.join(buffers))
+            return
+        buffers = [ memoryview(buf) for buf in buffers if len(buf) ]
+        while buffers:
+            n = self.sock.sendmsg(buffers[:_MAX_BUFFERS])
+            # Drop whatever was sent
+            while n:
+                if n >= len(buffers[0]):
+                    n -= len(buffers[0])
+                    del buffers[0]
+                else:
+                    buffers[0] = buffers[0][n:]
+                    n = 0
+
+    def _fill(self, nbytes):
+        # Make sure at least nbytes are buffered (nbytes <= buffer size)
+        if self._end - self._start >= nbytes:
+            return
+        if self._start + nbytes > len(self._buf):
+            # Not enough room left.  Move the unread data to the front
+            unread = self._end - self._start
+            self._buf[:unread] = self._view[self._start:self._end]
+            self._start, self._end = 0, unread
+        while self._end - self._start < nbytes:
+            n = self.sock.recv_into(self._view[self._end:])
+            if not n:   # EOF.
+                raise OSError("Incomplete message")
+            self._end += n
 
     def recv_exactly(self, nbytes):
-        msg = b''  
-        while len(msg) < nbytes:    
-            fragment = self.sock.recv(nbytes-len(msg))
-            if not fragment:   # EOF.
+        if nbytes <= len(self._buf):
+            self._fill(nbytes)
+            msg = bytes(self._view[self._start:self._start+nbytes])
+            self._start += nbytes
+            return msg
+        # Too big for the buffer.  Take what's buffered and receive the
+        # rest in place.  The message is a bytearray in this case
+        msg = bytearray(nbytes)
+        view = memoryview(msg)
+        have = self._end - self._start
+        view[:have] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while have < nbytes:
+            n = self.sock.recv_into(view[have:])
+            if not n:
                 raise OSError("Incomplete message")
-            msg += fragment
+            have += n
         return msg
 
     def recv(self):
         # Receive the size of the message
         # Receive the payload (exactly size bytes)
         # Return the message.
-        szmsg = self.recv_exactly(12)   # Get the 12-byte size
-        sz = int(szmsg)
-        msg = self.recv_exactly(sz)     # Get the rest of the message
-        return msg
+        self._fill(self._header_size)
+        start = self._start
+        self._start = start + self._header_size
+        sz, compressed = unpack_header(self._buf[start:self._start], self.binary_header)
+        if compressed:
+            return self.compression.decompress(self.recv_exactly(sz))
+        return self.recv_exactly(sz)
 
 # For "testing" (experimentation) only
 
@@ -0,0 +1,329 @@
+# codec.py
+#
+# Binary wire encoding of Raft messages (replaces pickle)
+#
+# Every message starts with a fixed header
+#
+#     version  (1 byte, must match CODEC_VERSION)
+#     code     (1 byte, the message type, see _types below)
+#     source   (int32, -1 for None)
+#     dest     (int32)
+#     term     (int64)
+#
+# followed by the fixed size fields of the message type.  Header and
+# fields are packed and unpacked with a single precompiled struct per
+# message type.  AppendEntries ends with its entries:
+#
+#     terms    (count uint32s)
+#     sizes    (count uint32s)
+#     payloads (sizes[0] + sizes[1] + ... bytes)
+#
+# where a payload is the entry's item encoded with encode_value() (and
+# cached on the LogEntry).  Decoding entries doesn't decode payloads.
+# Entries hang on to the bytes and decode the item when it's first used
+# (normally when the entry is applied).  Followers never look at most of
+# the entries they receive until then, and they forward the bytes as is
+# if they become leader.  InstallSnapshot ends with its data.
+#
+# Only plain data types are supported (None, bool, int, float, str,
+# bytes, tuple, list, dict).  Unlike pickle, decoding can't create
+# arbitrary objects, so a misbehaving peer can't run code on us.  A
+# payload that doesn't decode raises CodecError when the entry is used.
+
+import struct
+from functools import lru_cache
+from itertools import accumulate, repeat
+
+from .message import (AppendEntries, AppendEntriesResponse, RequestVote, RequestVoteResponse,
+                      InstallSnapshot, InstallSnapshotResponse)
+from . import machine
+
+CODEC_VERSION = 6
+
+class CodecError(ValueError):
+    pass
+
+# Per-message fields and their struct formats.  AppendEntries and
+# InstallSnapshot have one more value at the end: the number of entries
+# and the size of the data.
+_header = '>BBiiq'
+_types = {
+    AppendEntries: (1, 'qqqqI', ('prevLogIndex', 'prevLogTerm', 'leaderCommit', 'readSeq')),
+    AppendEntriesResponse: (2, '?qqqqq', ('success', 'matchIndex', 'rejectIndex',
+                                          'conflictTerm', 'conflictIndex', 'readSeq')),
+    RequestVote: (3, 'qq', ('lastLogIndex', 'lastLogTerm')),
+    RequestVoteResponse: (4, '?', ('voteGranted',)),
+    InstallSnapshot: (5, 'qqQ?I', ('lastIncludedIndex', 'lastIncludedTerm', 'offset', 'done')),
+    InstallSnapshotResponse: (6, 'qQ?', ('lastIncludedIndex', 'offset', 'done')),
+}
+_structs = { cls: (code, struct.Struct(_header + fmt), fields)
+             for cls, (code, fmt, fields) in _types.items() }
+_codes = { code: (cls, st, ('source', 'dest', 'term') + fields)
+           for cls, (code, st, fields) in _structs.items() }
+
+# Terms and sizes of count entries
+@lru_cache(maxsize=256)
+def _entry_header(count):
+    return struct.Struct(f'>{2*count}I')
+
+def encode(msg):
+    code, st, fields = _structs[type(msg)]
+    values = [ getattr(msg, name) for name in fields ]
+    source = -1 if msg.source is None else msg.source
+    if code == 1:
+        entries = msg.entries
+        payloads = [ e.payload for e in entries ]
+        header = st.pack(CODEC_VERSION, code, source, msg.dest, msg.term, *values, len(entries))
+        sizes = _entry_header(len(entries)).pack(*[ e.term for e in entries ],
+                                                 *map(len, payloads))
+        return b''.join([header, sizes, *payloads])
+    elif code == 5:
+        header = st.pack(CODEC_VERSION, code, source, msg.dest, msg.term, *values, len(msg.data))
+        return header + msg.data
+    else:
+        return st.pack(CODEC_VERSION, code, source, msg.dest, msg.term, *values)
+
+def decode(data):
+    try:
+        return _decode(data)
+    except (KeyError, IndexError, TypeError, struct.error) as e:
+        raise CodecError(f'Bad message: {e!r}') from None
+
+def _decode(data):
+    version, code = data[0], data[1]
+    if version != CODEC_VERSION:
+        raise CodecError(f'Unsupported version {version}')
+    cls, st, names = _codes[code]
+    values = st.unpack_from(data)
+    pos = st.size
+    kwargs = dict(zip(names, values[2:]))
+    if kwargs['source'] == -1:
+        kwargs['source'] = None
+    if code == 1:
+        count = values[-1]
+        if not count:
+            if pos != len(data):
+                raise CodecError('Extra data after message')
+            return cls(entries=[], **kwargs)     # Heartbeat
+        header = _entry_header(count)
+        sizes = header.unpack_from(data, pos)
+        ends = list(accumulate(sizes[count:], initial=pos + header.size))
+        pos = ends[-1]
+        if pos > len(data):
+            raise CodecError('Truncated entries')
+        payloads = [ data[start:end] for start, end in zip(ends, ends[1:]) ]
+        if type(data) is not bytes:
+            payloads = list(map(bytes, payloads))
+        kwargs['entries'] = list(map(machine.LogEntry, sizes[:count],
+                                     repeat(machine.LogEntry.UNDECODED, count), payloads))
+    elif code == 5:
+        size = values[-1]
+        if pos + size > len(data):
+            raise CodecError('Truncated snapshot data')
+        kwargs['data'] = bytes(data[pos:pos+size])
+        pos += size
+    if pos != len(data):
+        raise CodecError('Extra data after message')
+    return cls(**kwargs)
+
+# Varints for values.  Limited to 64 bits
+_MAX_VARINT = 10
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (~n << 1) | 1
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def _put_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _get_varint(data, pos):
+    b = data[pos]
+    if b < 0x80:
+        return b, pos + 1
+    n = b & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        b = data[pos]
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos + 1
+        shift += 7
+        if shift >= 7 * _MAX_VARINT:
+            raise CodecError('Varint too long')
+
+# Encoding of entry payloads.  One tag byte followed by the value.
+# Ints are zigzag varints (or 'I' and their bytes if bigger than 64
+# bits).  Lengths and counts are varints.  Encoders and decoders are
+# looked up by type and tag in dicts.
+_float = struct.Struct('>d')
+_MAX_DEPTH = 32
+
+def encode_value(value):
+    # Raises TypeError for types that can't be encoded
+    out = bytearray()
+    _encode_value(value, out)
+    return bytes(out)
+
+def _encode_value(value, out):
+    try:
+        encoder = _encoders[type(value)]
+    except KeyError:
+        raise TypeError(f"Can't encode {type(value).__name__}") from None
+    encoder(value, out)
+
+def _encode_none(value, out):
+    out += b'N'
+
+def _encode_bool(value, out):
+    out += b'T' if value else b'F'
+
+def _encode_int(value, out):
+    if -2**63 <= value < 2**63:
+        out += b'i'
+        _put_varint(_zigzag(value), out)
+    else:
+        raw = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+        out += b'I'
+        _put_varint(len(raw), out)
+        out += raw
+
+def _encode_float(value, out):
+    out += b'f'
+    out += _float.pack(value)
+
+def _encode_str(value, out):
+    raw = value.encode('utf-8')
+    out += b's'
+    _put_varint(len(raw), out)
+    out += raw
+
+def _encode_bytes(value, out):
+    out += b'b'
+    _put_varint(len(value), out)
+    out += value
+
+def _encode_sequence(value, out):
+    out += b't' if type(value) is tuple else b'l'
+    _put_varint(len(value), out)
+    for item in value:
+        _encode_value(item, out)
+
+def _encode_dict(value, out):
+    out += b'd'
+    _put_varint(len(value), out)
+    for key, item in value.items():
+        _encode_value(key, out)
+        _encode_value(item, out)
+
+_encoders = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    tuple: _encode_sequence,
+    list: _encode_sequence,
+    dict: _encode_dict,
+}
+
+def decode_value(data):
+    try:
+        value, _ = _decode_value(bytes(data), 0, 0)
+        return value
+    except (struct.error, KeyError, IndexError, TypeError, UnicodeDecodeError) as e:
+        raise CodecError(f'Bad value: {e!r}') from None
+
+def _decode_value(data, pos, depth):
+    try:
+        return _decoders[data[pos]](data, pos + 1, depth)
+    except KeyError:
+        raise CodecError(f'Unknown value tag {data[pos]}') from None
+
+def _decode_none(data, pos, depth):
+    return None, pos
+
+def _decode_true(data, pos, depth):
+    return True, pos
+
+def _decode_false(data, pos, depth):
+    return False, pos
+
+def _decode_int(data, pos, depth):
+    value, pos = _get_varint(data, pos)
+    return _unzigzag(value), pos
+
+def _decode_float(data, pos, depth):
+    return _float.unpack_from(data, pos)[0], pos + 8
+
+def _decode_raw(data, pos):
+    size, pos = _get_varint(data, pos)
+    if pos + size > len(data):
+        raise CodecError('Truncated value')
+    return data[pos:pos+size], pos + size
+
+def _decode_str(data, pos, depth):
+    size = data[pos]
+    if size < 0x80:
+        pos += 1        # Short string (the usual case)
+    else:
+        size, pos = _get_varint(data, pos)
+    end = pos + size
+    if end > len(data):
+        raise CodecError('Truncated value')
+    return data[pos:end].decode('utf-8'), end
+
+def _decode_bytes(data, pos, depth):
+    return _decode_raw(data, pos)
+
+def _decode_bigint(data, pos, depth):
+    raw, pos = _decode_raw(data, pos)
+    return int.from_bytes(raw, 'big', signed=True), pos
+
+def _decode_items(data, pos, depth):
+    if depth >= _MAX_DEPTH:
+        raise CodecError('Value nested too deeply')
+    size, pos = _get_varint(data, pos)
+    items = []
+    for n in range(size):
+        item, pos = _decoders[data[pos]](data, pos + 1, depth + 1)
+        items.append(item)
+    return items, pos
+
+def _decode_list(data, pos, depth):
+    return _decode_items(data, pos, depth)
+
+def _decode_tuple(data, pos, depth):
+    items, pos = _decode_items(data, pos, depth)
+    return tuple(items), pos
+
+def _decode_dict(data, pos, depth):
+    if depth >= _MAX_DEPTH:
+        raise CodecError('Value nested too deeply')
+    size, pos = _get_varint(data, pos)
+    value = {}
+    for n in range(size):
+        key, pos = _decode_value(data, pos, depth + 1)
+        value[key], pos = _decode_value(data, pos, depth + 1)
+    return value, pos
+
+_decoders = {
+    ord('N'): _decode_none,
+    ord('T'): _decode_true,
+    ord('F'): _decode_false,
+    ord('i'): _decode_int,
+    ord('I'): _decode_bigint,
+    ord('f'): _decode_float,
+    ord('s'): _decode_str,
+    ord('b'): _decode_bytes,
+    ord('l'): _decode_list,
+    ord('t'): _decode_tuple,
+    ord('d'): _decode_dict,
+}
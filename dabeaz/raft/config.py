@@ -6,6 +6,109 @@ LEADER_TIMEOUT = 1
 ELECTION_TIMEOUT = 3
 ELECTION_TIMEOUT_SPREAD = 0.5
 
+# Durability of the Raft log.  One of 'always' (fsync every write),
+# 'group' (one fsync per batch of events) or 'interval' (background fsync
+# every LOG_SYNC_INTERVAL seconds).  See storage.py
+LOG_SYNC_MODE = 'group'
+GROUP_COMMIT_WINDOW = 0.002
+LOG_SYNC_INTERVAL = 1.0
+
+# Max number of AppendEntries messages a leader keeps in flight to each
+# follower (pipelining)
+MAX_INFLIGHT_APPENDS = 4
+
+# Limits on the size of a single AppendEntries message.  A follower that's
+# far behind catches up over several messages.
+MAX_APPEND_ENTRIES = 1000
+MAX_APPEND_BYTES = 1048576
+
+# Leader batching of new entries.  A new entry is held for up to
+# APPEND_BATCH_DELAY microseconds so that entries arriving close together
+# go out in one AppendEntries per follower.  The batch is sent early once
+# APPEND_BATCH_ENTRIES entries are waiting.  0 sends every entry right
+# away (lowest latency).
+APPEND_BATCH_DELAY = 0
+APPEND_BATCH_ENTRIES = 100
+
+# Entries are committed (and leaders elected) once stored on (voted for
+# by) servers with a total weight of QUORUM_SIZE.  Servers not in
+# QUORUM_WEIGHTS have weight 1.  None means a majority of the total
+# weight.  QUORUM_SIZE must be more than half the total weight.
+QUORUM_WEIGHTS = { }
+QUORUM_SIZE = None
+
+# Snapshot the applied state (and discard the log it covers) after this
+# many entries have been applied since the last snapshot.  Snapshots are
+# sent to lagging followers in chunks of SNAPSHOT_CHUNK_SIZE bytes
+SNAPSHOT_THRESHOLD = 10000
+SNAPSHOT_CHUNK_SIZE = 65536
+
+# Maximum number of events the controller processes before syncing
+MAX_EVENT_BATCH = 1000
+
+# Maximum number of messages a dispatcher writes to a peer at once.
+# Whatever is queued for the peer (up to this many) goes out in a single
+# write.
+DISPATCH_MAX_BATCH = 64
+
+# Messages carrying log entries or snapshot data go to each peer over a
+# second connection so they can't hold up heartbeats, votes and
+# responses (see dispatcher.py)
+DISPATCH_BULK_LANE = True
+
+# Messages waiting to go to a peer (per lane).  When the queue is full,
+# the oldest are dropped.  A peer that can't be reached is retried after
+# DISPATCH_RECONNECT_BACKOFF seconds (randomized), doubling up to
+# DISPATCH_RECONNECT_BACKOFF_MAX.  Connecting gives up after
+# DISPATCH_CONNECT_TIMEOUT seconds.
+DISPATCH_QUEUE_SIZE = 1000
+DISPATCH_RECONNECT_BACKOFF = 0.05
+DISPATCH_RECONNECT_BACKOFF_MAX = 2.0
+DISPATCH_CONNECT_TIMEOUT = 1.0
+
+# Lease reads.  A leader that has heard from a quorum within the last
+# ELECTION_TIMEOUT - CLOCK_DRIFT_BOUND seconds answers reads locally.
+# Servers then ignore RequestVote while they're hearing from a leader.
+# Safe as long as no server's clock runs fast enough to gain more than
+# CLOCK_DRIFT_BOUND seconds over an election timeout.
+READ_LEASE = False
+CLOCK_DRIFT_BOUND = 0.5
+
+# Followers answer gets that give a minimum log index or a maximum
+# staleness.  They wait up to FOLLOWER_READ_TIMEOUT seconds to catch up.
+FOLLOWER_READ_TIMEOUT = 1.0
+
+# Clients looking for the leader wait about KV_CONNECT_BACKOFF seconds
+# (randomized) between attempts.  The wait doubles up to
+# KV_CONNECT_BACKOFF_MAX
+KV_CONNECT_BACKOFF = 0.05
+KV_CONNECT_BACKOFF_MAX = 2.0
+
+# AsyncKVClient keeps up to KV_POOL_SIZE connections to each server and
+# gives up on a request after KV_REQUEST_TIMEOUT seconds.  Servers give
+# up on unpipelined (name, args) requests after the same time.
+KV_POOL_SIZE = 4
+KV_REQUEST_TIMEOUT = 5.0
+
+# Client sessions (exactly-once writes).  The servers remember each
+# client's recent write results so a retried write isn't applied twice.
+# Sessions unused for KV_SESSION_TTL seconds are dropped, as are the
+# least recently used ones beyond KV_MAX_SESSIONS.
+KV_SESSION_TTL = 3600.0
+KV_MAX_SESSIONS = 100000
+
+# Controller debug logging to log-{addr}.txt (or .bin for binary records).
+# Level is 'debug' (every event and message), 'info' or 'off'.  Records
+# are written by a background thread.  Up to DEBUG_LOG_BUFFER records can
+# be waiting to be written before more are dropped.
+DEBUG_LOG_LEVEL = 'info'
+DEBUG_LOG_BINARY = False
+DEBUG_LOG_BUFFER = 100000
+
+# How servers run.  'thread' (control.py) or 'asyncio' (aiocontrol.py).
+# Can also be given on the command line of server.py and kvserver.py
+RAFT_RUNTIME = 'thread'
+
 # Connection endpoints for each server
 RAFT_SERVER_CONFIG = [
     ('localhost', 19000),
@@ -23,3 +126,20 @@ KV_SERVER_CONFIG = [
     ('localhost', 20003),
     ('localhost', 20004)
 ]
+
+# Channel framing.  Messages are preceded by their size, either as 12
+# ASCII digits or (CHANNEL_BINARY_HEADER) a 4 byte big-endian integer.
+# Every server and client must use the same setting.  Channels receive
+# into a buffer of CHANNEL_BUFFER_SIZE bytes.  Messages bigger than
+# CHANNEL_MAX_MESSAGE bytes (before or after decompression) are refused
+# and the connection dropped.
+CHANNEL_BINARY_HEADER = False
+CHANNEL_BUFFER_SIZE = 65536
+CHANNEL_MAX_MESSAGE = 256 * 1024 * 1024
+
+# Compression of messages between Raft servers.  Compressors offered or
+# accepted, in order of preference ('zlib', 'lzma', or any added with
+# channel.register_compressor()).  Empty for none.  Only messages of at
+# least CHANNEL_COMPRESS_THRESHOLD bytes are compressed.
+CHANNEL_COMPRESSION = ['zlib']
+CHANNEL_COMPRESS_THRESHOLD = 4096
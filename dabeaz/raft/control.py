@@ -6,62 +6,161 @@ import threading
 import queue
 import time
 import random
+import pickle
+from concurrent.futures import Future
 
-from .machine import RaftMachine
+from .machine import RaftMachine, Leader
+from .timers import get_timer_service
+from .debuglog import DebugLog
 from .config import *
 
+class NotLeaderError(Exception):
+    pass
+
 class RaftControllerBase:
-    def apply_entries(self, entries):
+    # Apply committed entries.  index is the log index of entries[0]
+    def apply_entries(self, entries, index):
+        pass
+
+    # Snapshots of the application state.  create_snapshot() returns
+    # bytes (or None if snapshots aren't supported)
+    def create_snapshot(self):
+        return None
+
+    def restore_snapshot(self, data):
+        pass
+
+    # Called when this server stops being the leader
+    def leader_lost(self):
         pass
 
 class RaftController(RaftControllerBase):
-    def __init__(self, addr, dispatcher, machine, applicator=None):
+    def __init__(self, addr, dispatcher, machine, applicator=None,
+                 snapshotter=None, restorer=None, timers=None):
         self.addr = addr
         self.dispatcher = dispatcher
         self.machine = machine
-        self.applicator = applicator
+        self.applicator = applicator      # Called with (entries, index)
+        self.snapshotter = snapshotter    # Returns the application state as bytes
+        self.restorer = restorer          # Replaces the application state
 
         machine.control = self
 
         self.peers = [ i for i in range(dispatcher.nservers) if i != addr ]
         self.nservers = dispatcher.nservers
         self.event_queue = queue.Queue()
+        self._outbox = [ ]        # Messages held until the log is synced
+        self._pending = { }       # index -> (term, Future) for append_entry()
+        self._waiters = [ ]       # (condition, Future) for wait_applied()/wait_fresh()
         self.running = False
         self._paused = False
 
-        # Debug logging
-        self.debug_log = open(f'log-{addr}.txt', 'wt')
+        # Timers run by a TimerService (by default, one shared by every
+        # controller in the process)
+        self.timers = timers or get_timer_service()
+        self._leader_timer = self._election_timer = None
+        self._leader_gen = self._election_gen = 0
+
+        # Debug logging (see debuglog.py and DEBUG_LOG_LEVEL)
+        self.debug_log = DebugLog(f'log-{addr}')
+
+    def apply_entries(self, entries, index):
+        self.debug_log.debug('Applying %s', entries)
+        # The applicator may return a list with a result for each entry
+        results = self.applicator(entries, index) if self.applicator else None
+        if self._pending:
+            for n, entry in enumerate(entries):
+                if index + n in self._pending:
+                    term, fut = self._pending.pop(index + n)
+                    if entry.term == term:
+                        fut.set_result(results[n] if results else None)
+                    else:
+                        fut.set_exception(NotLeaderError('Entry replaced by a new leader'))
+
+    def create_snapshot(self):
+        if self.snapshotter:
+            return self.snapshotter()
+
+    def restore_snapshot(self, data):
+        self.debug_log.info('Restoring snapshot (%d bytes)', len(data))
+        if self.restorer:
+            self.restorer(data)
+        # Can't know if entries covered by the snapshot were ours
+        for index in [ index for index in self._pending if index <= self.machine.log.snapshotIndex ]:
+            term, fut = self._pending.pop(index)
+            fut.set_exception(NotLeaderError('Entry outcome unknown'))
 
-    def apply_entries(self, entries):
-        self.debug_log.write(f'Applying {entries}\n')
-        self.debug_log.flush()
-        if self.applicator:
-            self.applicator(entries)
+    def leader_lost(self):
+        # Entries not yet applied may or may not be committed by the new
+        # leader (or be cut from the log).  Either way, this server won't
+        # hear of it as leader, so they fail now.  Clients can retry
+        # writes in their sessions (see kvserver.py).
+        pending, self._pending = self._pending, { }
+        for term, fut in pending.values():
+            fut.set_exception(NotLeaderError('Leadership lost. Entry outcome unknown'))
 
     # Commands used by the machine
     def send_message(self, msg):
         msg.source = self.addr
-        self.debug_log.write(f'{self.addr}: send_message({msg})\n')
-        self.debug_log.flush()
-        self.dispatcher.send_message(msg)
+        self.debug_log.debug('%s: send_message(%s)', self.addr, msg)
+        self._outbox.append(msg)
 
     # The main event loop
     def start(self):
         self.running = True
         print(f"Starting server: {self.addr}")
+        self.reset_leader_timeout()
+        self.reset_election_timer()
         threading.Thread(target=self.run, daemon=True).start()
         threading.Thread(target=self.run_receiver, daemon=True).start()
-        threading.Thread(target=self.run_leader_timer, daemon=True).start()
-        threading.Thread(target=self.run_election_timer, daemon=True).start()
 
     def run(self):
         while self.running:
-            evt, *args = self.event_queue.get()
-            if not self._paused:
-                self.debug_log.write(f'{self.addr}: {evt} {args}\n')
-                self.debug_log.flush()
+            self.handle_event(self.event_queue.get())
+            self.run_batch()
+            self.check_waiters()
+            # Nothing may leave this server until the log changes made
+            # by the batch are on disk.  One sync covers the whole batch.
+            self.machine.storage.sync()
+            self.flush_messages()
+
+    def run_batch(self):
+        # Process any further events that arrive within the storage
+        # commit window (group commit).
+        window = self.machine.storage.commit_window
+        deadline = time.monotonic() + window
+        for _ in range(MAX_EVENT_BATCH):
+            try:
+                if window:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        return
+                    evt = self.event_queue.get(timeout=timeout)
+                else:
+                    evt = self.event_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.handle_event(evt)
+
+    def post(self, event):
+        # Add an event to the queue (from any thread)
+        self.event_queue.put(event)
+
+    def handle_event(self, event):
+        # An event is a machine method name or a controller method
+        evt, *args = event
+        if not self._paused:
+            self.debug_log.debug('%s: %s %s', self.addr, evt, args)
+            if callable(evt):
+                evt(*args)
+            else:
                 getattr(self.machine, evt)(*args)
 
+    def flush_messages(self):
+        outbox, self._outbox = self._outbox, [ ]
+        for msg in outbox:
+            self.dispatcher.send_message(msg)
+
     def pause(self):
         self._paused = True
 
@@ -73,55 +172,153 @@ class RaftController(RaftControllerBase):
             msg = self.dispatcher.recv_message(self.addr)
             self.event_queue.put(('handle_Message', msg))
 
-    def run_leader_timer(self):
-        self._leader_deadline = 0
-        while self.running:
-            delay = self._leader_deadline - time.monotonic()
-            if delay <= 0:
-                delay = LEADER_TIMEOUT
-                self._leader_deadline = time.monotonic() + delay
-            time.sleep(delay)
-            if time.monotonic() > self._leader_deadline:
-                self.event_queue.put(('handle_LeaderTimeout',))
+    # Timers.  Resetting a timer cancels the old one and schedules a new
+    # one.  A timeout event that was already queued when the timer was
+    # reset is recognized by its generation number and ignored.
+    def call_later(self, delay, event):
+        # Put event on the queue after delay seconds.  Returns a timer
+        # with a cancel() method
+        return self.timers.call_later(delay, self.event_queue.put, event)
 
     def reset_leader_timeout(self):
-        self.debug_log.write(f'{self.addr}: reset_leader_timeout\n')
-        self.debug_log.flush()
-        self._leader_deadline = time.monotonic() + LEADER_TIMEOUT
+        self.debug_log.debug('%s: reset_leader_timeout', self.addr)
+        self._leader_gen += 1
+        if self._leader_timer:
+            self._leader_timer.cancel()
+        self._leader_timer = self.call_later(LEADER_TIMEOUT, (self._leader_timeout, self._leader_gen))
+
+    def _leader_timeout(self, gen):
+        if gen == self._leader_gen:
+            self.reset_leader_timeout()
+            self.machine.handle_LeaderTimeout()
 
-    def run_election_timer(self):
-        self._election_deadline = 0
-        while self.running:
-            delay = self._election_deadline - time.monotonic()
-            if delay <= 0:
-                self.new_election_deadline()
-            time.sleep(self._election_deadline - time.monotonic())
-            if time.monotonic() > self._election_deadline:
-                self.event_queue.put(('handle_ElectionTimeout',))
-
-    def new_election_deadline(self):
-        new_deadline = time.monotonic() + random.random() * ELECTION_TIMEOUT_SPREAD + ELECTION_TIMEOUT
-        if new_deadline > self._election_deadline:
-            self._election_deadline = new_deadline
-        
     def reset_election_timer(self):
-        self.debug_log.write(f'{self.addr}: reset_election_timer\n')
-        self.debug_log.flush()
-        self.new_election_deadline()
+        self.debug_log.debug('%s: reset_election_timer', self.addr)
+        self._election_gen += 1
+        if self._election_timer:
+            self._election_timer.cancel()
+        delay = random.random() * ELECTION_TIMEOUT_SPREAD + ELECTION_TIMEOUT
+        self._election_timer = self.call_later(delay, (self._election_timeout, self._election_gen))
+
+    def _election_timeout(self, gen):
+        if gen == self._election_gen:
+            self.reset_election_timer()
+            self.machine.handle_ElectionTimeout()
 
-    # Client function.  Add a new entry to the machine log
+    def clock(self):
+        return time.monotonic()
+
+    def schedule_flush(self, delay):
+        # Send entries held for batching after delay seconds
+        self.call_later(delay, ('flush_NewEntries',))
+
+    # Client function.  Add a new entry to the machine log.  Returns a
+    # Future that completes when the entry has been committed and applied.
+    # Its result is whatever the applicator returned for the entry.  Once
+    # the entry is in the log, future.index holds its log index.  Any
+    # number of entries can be in progress at once.
     def append_entry(self, item):
-        self.event_queue.put(('append_new_entry', item))
+        fut = Future()
+        self.post((self._append_entry, item, fut))
+        return fut
+
+    def _append_entry(self, item, fut):
+        if self.machine.state is not Leader:
+            fut.set_exception(NotLeaderError(f'Server {self.addr} is not the leader'))
+            return
+        fut.index = len(self.machine.log)
+        self._pending[fut.index] = (self.machine.term, fut)
+        try:
+            self.machine.append_new_entry(item)
+        except TypeError as e:
+            # Not something that can be sent to the followers
+            del self._pending[fut.index]
+            fut.set_exception(e)
+
+    # Client function.  Returns a Future that completes once the applied
+    # state can be read with the guarantee that it includes every write
+    # committed before the call (linearizable).  The result is the log
+    # index that has been applied.  Fails with NotLeaderError if this
+    # server isn't (or stops being) the leader.
+    def read_index(self):
+        fut = Future()
+        self.post((self._read_index, fut))
+        return fut
+
+    def _read_index(self, fut):
+        if self.machine.state is not Leader:
+            fut.set_exception(NotLeaderError(f'Server {self.addr} is not the leader'))
+        else:
+            self.machine.read_index(fut)
+
+    # Client functions for reads from followers.  Each returns a Future
+    # that completes once the applied state includes the log up to index
+    # (wait_applied) or was up to date with the leader no more than
+    # staleness seconds ago (wait_fresh).  Cancel the Future to give up.
+    def wait_applied(self, index):
+        return self._wait(lambda: self.machine.lastApplied >= index)
+
+    def wait_fresh(self, staleness):
+        return self._wait(lambda: self.machine.staleness() <= staleness)
+
+    def _wait(self, condition):
+        fut = Future()
+        self.post((self._add_waiter, condition, fut))
+        return fut
+
+    def _add_waiter(self, condition, fut):
+        self._waiters.append((condition, fut))
+
+    def check_waiters(self):
+        # Called after every batch of events
+        if self._waiters:
+            waiting = [ ]
+            for condition, fut in self._waiters:
+                if fut.done():
+                    continue       # Cancelled
+                if condition():
+                    # Unless it was just cancelled (by another thread)
+                    if fut.set_running_or_notify_cancel():
+                        fut.set_result(self.machine.lastApplied)
+                else:
+                    waiting.append((condition, fut))
+            self._waiters = waiting
 
+    # Client function.  True if this server is the leader and holds a read
+    # lease (READ_LEASE).  The applied state can then be read directly.
+    # Can be called from any thread.
+    def has_lease(self):
+        return self.machine.has_lease()
+
+    # Used by the machine when a read_index() completes
+    def read_ready(self, fut, index):
+        fut.set_result(index)
+
+    def read_failed(self, fut):
+        fut.set_exception(NotLeaderError(f'Server {self.addr} lost leadership'))
 
 class MockRaftController(RaftControllerBase):
     def __init__(self, id, nservers):
         self.id = id
+        self.addr = id
         self.nservers = nservers
         self.peers = [ i for i in range(nservers) if i != id ]
         self.messages = []
         self.election_timer_reset = False
         self.leader_timeout_reset = False
+        self.flush_delay = None
+        self.applied = []
+        self.reads = []
+        self.time = 0
+
+    def apply_entries(self, entries, index):
+        self.applied.extend(e.entry for e in entries)
+
+    def create_snapshot(self):
+        return pickle.dumps(self.applied)
+
+    def restore_snapshot(self, data):
+        self.applied = pickle.loads(data)
 
     def send_message(self, msg):
         msg.source = self.id
@@ -133,6 +330,18 @@ class MockRaftController(RaftControllerBase):
     def reset_leader_timeout(self):
         self.leader_timeout_reset = True
 
+    def schedule_flush(self, delay):
+        self.flush_delay = delay
+
+    def clock(self):
+        return self.time
+
+    def read_ready(self, token, index):
+        self.reads.append((token, index))
+
+    def read_failed(self, token):
+        self.reads.append((token, None))
+
     def append_log_entry(self, entry):
         pass
 
@@ -0,0 +1,154 @@
+# debuglog.py
+#
+# Debug logging for the controllers.
+#
+# Logging used to be a formatted write() and flush() on the controller's
+# own thread for every message and event.  Now a call does nothing but a
+# level check unless the level is enabled.  If it is, the arguments are
+# put on a queue and formatted and written by a background thread (one
+# for the whole process).  Arguments are formatted later, so they
+# shouldn't be changed after they're logged (messages and entries never
+# are).  If the writer can't keep up and the queue fills, records are
+# dropped and the number dropped is written to the log.
+#
+# Logs are either text (one line per record) or binary records:
+#
+#     time    (float64)
+#     level   (uint8)
+#     size    (uint32)
+#     payload (pickled (format, args))
+#
+# Binary logs are cheaper to write and can be turned into text with
+#
+#     python -m dabeaz.raft.debuglog log-0.bin
+
+import pickle
+import queue
+import struct
+import sys
+import threading
+import time
+
+from .config import DEBUG_LOG_LEVEL, DEBUG_LOG_BINARY, DEBUG_LOG_BUFFER
+
+DEBUG = 10
+INFO = 20
+OFF = 100
+
+LEVELS = { 'debug': DEBUG, 'info': INFO, 'off': OFF }
+_names = { DEBUG: 'DEBUG', INFO: 'INFO' }
+
+_record = struct.Struct('>dBI')
+
+class DebugLog:
+    def __init__(self, path, level=DEBUG_LOG_LEVEL, binary=DEBUG_LOG_BINARY):
+        self.level = LEVELS.get(level, level)
+        self.path = path + ('.bin' if binary else '.txt')
+        self.binary = binary
+        self.dropped = 0
+        self._file = None
+        if self.level < OFF:
+            self._file = open(self.path, 'wb' if binary else 'wt')
+
+    def debug(self, fmt, *args):
+        if self.level <= DEBUG:
+            self._log(DEBUG, fmt, args)
+
+    def info(self, fmt, *args):
+        if self.level <= INFO:
+            self._log(INFO, fmt, args)
+
+    def _log(self, level, fmt, args):
+        try:
+            _writer().put_nowait((self, time.time(), level, fmt, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, t, level, fmt, args):
+        # Called by the writer thread
+        if self.binary:
+            try:
+                payload = pickle.dumps((fmt, args))
+            except Exception:
+                payload = pickle.dumps((fmt, tuple(repr(arg) for arg in args)))
+            self._file.write(_record.pack(t, level, len(payload)))
+            self._file.write(payload)
+        else:
+            self._file.write(format_record(t, level, fmt, args) + '\n')
+
+    def close(self):
+        # Write everything queued so far and close the file
+        if self._file:
+            done = threading.Event()
+            _writer().put((None, done))
+            done.wait()
+            self._file.close()
+            self._file = None
+
+def format_record(t, level, fmt, args):
+    try:
+        text = fmt % args
+    except Exception:
+        text = f'{fmt} {args!r}'
+    return f'{t:.6f} {_names.get(level, level)} {text}'
+
+# The writer thread.  Started with the first record
+_queue = None
+_lock = threading.Lock()
+
+def _writer():
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                q = queue.Queue(maxsize=DEBUG_LOG_BUFFER)
+                threading.Thread(target=_run_writer, args=(q,), daemon=True).start()
+                _queue = q
+    return _queue
+
+def _run_writer(q):
+    dirty = set()
+    while True:
+        if not dirty or not q.empty():
+            item = q.get()
+        else:
+            # Queue drained.  Flush what was written
+            for log in dirty:
+                if log._file:
+                    log._file.flush()
+            dirty.clear()
+            continue
+        log, *rest = item
+        if log is None:
+            # close() marker
+            for log in dirty:
+                if log._file:
+                    log._file.flush()
+            dirty.clear()
+            rest[0].set()
+            continue
+        if log._file is None:
+            continue
+        if log.dropped:
+            dropped, log.dropped = log.dropped, 0
+            log._write(rest[0], INFO, '%d records dropped', (dropped,))
+        log._write(*rest)
+        dirty.add(log)
+
+def read_binary_log(path):
+    # Generator producing (time, level, format, args) from a binary log
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + _record.size <= len(data):
+        t, level, size = _record.unpack_from(data, pos)
+        pos += _record.size
+        if pos + size > len(data):
+            break
+        fmt, args = pickle.loads(data[pos:pos+size])
+        pos += size
+        yield t, level, fmt, args
+
+if __name__ == '__main__':
+    for record in read_binary_log(sys.argv[1]):
+        print(format_record(*record))
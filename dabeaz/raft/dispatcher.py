@@ -1,11 +1,15 @@
 # dispatcher.py
 
+import collections
 import queue
-import pickle
+import random
 import threading
 import socket
+import time
 
 from .channel import Channel
+from .message import AppendEntries, InstallSnapshot
+from . import codec
 from .config import *
 
 class Dispatcher:
@@ -19,13 +23,120 @@ class QueueDispatcher(Dispatcher):
     def __init__(self, nservers):
         self.nservers = nservers
         self.channels = [queue.Queue() for n in range(nservers) ]
+        self.counts = collections.Counter()     # Messages sent, by type
 
     def send_message(self, msg):
+        self.counts[type(msg).__name__] += 1
         self.channels[msg.dest].put(msg)
 
     def recv_message(self, addr):
         return self.channels[addr].get()
 
+# Socket dispatchers use two connections ("lanes") to each peer.  Bulk
+# messages (AppendEntries with entries and InstallSnapshot chunks) go on
+# one and everything else (heartbeats, votes, responses) on the other,
+# so a multi-megabyte catch-up message never delays a heartbeat.
+# Messages in different lanes can arrive out of order.  The machine
+# copes: heartbeats go out at the follower's last known match
+# (RaftMachine.send_AppendEntry) and repeated or reordered entries are
+# harmless.
+
+def is_bulk(msg):
+    if not DISPATCH_BULK_LANE:
+        return False
+    return type(msg) is InstallSnapshot or (type(msg) is AppendEntries and bool(msg.entries))
+
+def is_heartbeat(msg):
+    return type(msg) is AppendEntries and not msg.entries
+
+class SendQueue:
+    # Messages waiting to go to one peer (in one lane).  While the peer
+    # is down, messages pile up here, so the queue drops the ones that
+    # no longer matter:
+    #
+    #   - everything from an older term once a message of a newer term
+    #     is queued (the peer would ignore them anyway)
+    #   - an earlier heartbeat when a new one is queued
+    #   - the oldest message when there are DISPATCH_QUEUE_SIZE queued
+    #
+    # Lost messages are fine.  Raft retries whatever matters.  stats
+    # counts what happened to the messages.
+    def __init__(self, maxsize=DISPATCH_QUEUE_SIZE):
+        self.messages = collections.deque()
+        self.maxsize = maxsize
+        self.term = -1             # Newest term queued
+        self.heartbeats = 0        # Heartbeats queued (0 or 1)
+        self.stats = collections.Counter()
+
+    def put(self, msg):
+        if msg.term > self.term:
+            self.term = msg.term
+            self._drop_superseded(lambda m: m.term < msg.term)
+        if is_heartbeat(msg) and self.heartbeats:
+            self._drop_superseded(is_heartbeat)
+        self._add(msg, self.messages.append)
+
+    def requeue(self, msgs):
+        # Put back messages that couldn't be sent (ahead of the others)
+        for msg in reversed(msgs):
+            if msg.term < self.term or (is_heartbeat(msg) and self.heartbeats):
+                self.stats['superseded'] += 1
+            else:
+                self._add(msg, self.messages.appendleft)
+
+    def take(self, n):
+        # Remove up to n messages from the front
+        msgs = [ ]
+        while self.messages and len(msgs) < n:
+            msgs.append(self.messages.popleft())
+        self.heartbeats -= sum(map(is_heartbeat, msgs))
+        return msgs
+
+    def summary(self):
+        return dict(self.stats, queued=len(self.messages))
+
+    def _add(self, msg, add):
+        if len(self.messages) >= self.maxsize:
+            dropped = self.messages.popleft()
+            self.heartbeats -= is_heartbeat(dropped)
+            self.stats['dropped'] += 1
+        add(msg)
+        self.heartbeats += is_heartbeat(msg)
+
+    def _drop_superseded(self, superseded):
+        keep = [ m for m in self.messages if not superseded(m) ]
+        if len(keep) < len(self.messages):
+            self.stats['superseded'] += len(self.messages) - len(keep)
+            self.messages = collections.deque(keep)
+            self.heartbeats = sum(map(is_heartbeat, keep))
+
+class BlockingSendQueue(SendQueue):
+    # For threads
+    def __init__(self, maxsize=DISPATCH_QUEUE_SIZE):
+        super().__init__(maxsize)
+        self._cond = threading.Condition()
+
+    def put(self, msg):
+        with self._cond:
+            super().put(msg)
+            self._cond.notify()
+
+    def requeue(self, msgs):
+        with self._cond:
+            super().requeue(msgs)
+
+    def get(self, n):
+        # Wait for messages and take up to n
+        with self._cond:
+            while not self.messages:
+                self._cond.wait()
+            return self.take(n)
+
+def reconnect_delay(failures):
+    # Randomized exponential backoff after a number of failed attempts
+    backoff = min(DISPATCH_RECONNECT_BACKOFF * 2 ** (failures - 1), DISPATCH_RECONNECT_BACKOFF_MAX)
+    return backoff * (0.5 + random.random())
+
 # A Dispatcher that uses sockets
 
 class ChannelDispatcher(Dispatcher):
@@ -33,20 +144,35 @@ class ChannelDispatcher(Dispatcher):
         self.addr = addr
         self.nservers = len(RAFT_SERVER_CONFIG)
         self._recv_queue = queue.Queue()
-        self._send_queues = [ queue.Queue() for n in range(self.nservers) ]
+        self._send_queues = [ BlockingSendQueue() for n in range(self.nservers) ]
+        self._bulk_queues = [ BlockingSendQueue() for n in range(self.nservers) ]
+        # Compression (see channel.py) of the messages sent to each server
+        self.compression_stats = [ collections.Counter() for n in range(self.nservers) ]
+
+    def compression_ratios(self):
+        # Compressed size / original size of the messages compressed, by server
+        return { addr: stats['compressed_bytes'] / stats['bytes']
+                 for addr, stats in enumerate(self.compression_stats) if stats['bytes'] }
+
+    def link_stats(self):
+        # What happened to the messages for each server, by lane
+        return { addr: { 'control': self._send_queues[addr].summary(),
+                         'bulk': self._bulk_queues[addr].summary() }
+                 for addr in range(self.nservers) if addr != self.addr }
 
     def start(self):
         threading.Thread(target=self.raft_server, daemon=True).start()
         for n in range(self.nservers):
             if n != self.addr:
-                threading.Thread(target=self.raft_sender, args=(n,), daemon=True).start()
+                for send_queue in [ self._send_queues[n], self._bulk_queues[n] ]:
+                    threading.Thread(target=self.raft_sender, args=(n, send_queue), daemon=True).start()
 
     def recv_message(self, addr):
         assert addr == self.addr
         return self._recv_queue.get()
 
     def send_message(self, msg):
-        self._send_queues[msg.dest].put(msg)
+        (self._bulk_queues if is_bulk(msg) else self._send_queues)[msg.dest].put(msg)
 
     def raft_server(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -61,26 +187,43 @@ class ChannelDispatcher(Dispatcher):
     def raft_receiver(self, client):
         with client:
             ch = Channel(client)
-            while True:
-                msg = pickle.loads(ch.recv())
-                self._recv_queue.put(msg)
-
-    # Thread that sends messages to destination server
-    def raft_sender(self, addr):
+            try:
+                ch.accept_compression()
+                while True:
+                    msg = codec.decode(ch.recv())
+                    self._recv_queue.put(msg)
+            except ValueError as e:
+                # Drop the connection to a peer sending garbage (bad
+                # headers, compression offers or messages)
+                print(f'Server {self.addr}: {e!r}')
+            except OSError:
+                pass
+
+    # Thread that sends messages to destination server (one per lane).
+    # Everything queued (up to DISPATCH_MAX_BATCH messages) is sent with
+    # one write.  The receiver reads them in order as usual.  If the
+    # server can't be reached, the messages go back on the queue and
+    # the connection is retried after a backoff.
+    def raft_sender(self, addr, send_queue):
         ch = None
+        failures = 0
         while True:
-            msg = self._send_queues[addr].get()
+            msgs = send_queue.get(DISPATCH_MAX_BATCH)
             try:
                 if ch is None:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect(RAFT_SERVER_CONFIG[addr])
+                    sock = socket.create_connection(RAFT_SERVER_CONFIG[addr], DISPATCH_CONNECT_TIMEOUT)
+                    sock.settimeout(None)
                     ch = Channel(sock)
-                ch.send(pickle.dumps(msg))
+                    ch.offer_compression(stats=self.compression_stats[addr])
+                    send_queue.stats['connects'] += 1
+                ch.send_many([ codec.encode(msg) for msg in msgs ])
+                send_queue.stats['sent'] += len(msgs)
+                failures = 0
             except OSError:
-                ch = None
-        
-        
-        
-        
-    
-
+                if ch:
+                    ch.sock.close()
+                    ch = None
+                send_queue.requeue(msgs)
+                send_queue.stats['failures'] += 1
+                failures += 1
+                time.sleep(reconnect_delay(failures))
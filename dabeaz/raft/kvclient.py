@@ -8,29 +8,89 @@ from .channel import Channel
 import socket
 import time
 import pickle
+import random
+import threading
+import itertools
+import uuid
+from collections import deque
+from concurrent.futures import Future
+
+class KVError(Exception):
+    pass
+
+# Commands sent in the client's session (see KVServer.start_command)
+WRITES = { 'set', 'mset', 'mdelete' }
 
 class KVClient:
-    def __init__(self):
+    # Commands go to the leader over one connection.  Any number of them
+    # can be outstanding (see submit()).  Each request carries an id that
+    # the server puts on the response.  If the connection is lost or the
+    # server stops being the leader, unanswered commands are sent again
+    # to the (new) leader.  Writes carry the client id and a sequence
+    # number so the servers don't apply one twice.
+    #
+    # Gets with a min_index or max_staleness go to read_server (a server
+    # number) if given.  Any server can answer them.
+    def __init__(self, read_server=None):
         self.ch = None
+        self.leader = None         # Last known leader
+        self.read_server = read_server
+        self.read_ch = None
+        self.last_index = -1       # Log index of the last set
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending = { }        # Request id -> (Future, request)
+        self.client_id = uuid.uuid4().hex
+        self._seqs = itertools.count(1)
+        self._unanswered = set()   # Sequence numbers of writes in progress
+        self._acked = 0            # Every write up to here has been answered
+        self._connecting = False   # A thread is in _reconnect()
 
     def _connect(self):
+        # Find the leader.  Start with the last known one.  Servers that
+        # aren't the leader say which one is, and that one's tried next.
+        # After trying everything, wait and start over.  The wait is
+        # randomized (so clients don't all retry at once) and doubles
+        # each time.  Returns (channel, server number)
+        backoff = KV_CONNECT_BACKOFF
+        leader = self.leader
         while True:
-            for addr in KV_SERVER_CONFIG:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect(addr)
-                    self.ch = Channel(sock)
-                    resp = pickle.loads(self.ch.recv())
-                    if resp == 'ok':
-                        print("Connected to", sock)
-                        return
-                    else:
-                        sock.close()
-                        self.ch = None
-                except (OSError, pickle.PicklingError):
-                    sock.close()
-            print('No servers available. Retrying')
-            time.sleep(2)
+            tried = set()
+            order = deque(range(len(KV_SERVER_CONFIG)))
+            if leader is not None:
+                order.appendleft(leader)
+            while order:
+                n = order.popleft()
+                if n in tried:
+                    continue
+                tried.add(n)
+                ch, hint = self._try_connect(n)
+                if ch:
+                    return ch, n
+                if hint is not None:
+                    order.appendleft(hint)
+            leader = None
+            print(f'No leader available. Retrying in {backoff:.2f}s')
+            time.sleep(backoff * (0.5 + random.random()))
+            backoff = min(backoff * 2, KV_CONNECT_BACKOFF_MAX)
+
+    def _try_connect(self, n):
+        # Connect to server n.  Returns (channel, None) if it's the
+        # leader, (None, the leader it knows of) otherwise
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(KV_SERVER_CONFIG[n])
+            ch = Channel(sock)
+            resp = pickle.loads(ch.recv())
+            if resp == 'ok':
+                print("Connected to", sock)
+                return ch, None
+            sock.close()
+            if isinstance(resp, tuple) and resp[0] == 'follower':
+                return None, resp[1]
+        except (OSError, pickle.PicklingError):
+            sock.close()
+        return None, None
 
     def encode_command(self, name, *args):
         return pickle.dumps((name, args))
@@ -42,21 +102,174 @@ class KVClient:
         else:
             raise KVError(result)
         
+    def submit(self, name, *args):
+        # Send a command to the leader.  Returns a Future for the result
+        fut = Future()
+        with self._lock:
+            req_id = next(self._ids)
+            if name in WRITES:
+                request = (req_id, name, args, self._new_session_write())
+            else:
+                request = (req_id, name, args)
+            self._pending[req_id] = (fut, request)
+            if self.ch is not None:
+                try:
+                    self.ch.send(pickle.dumps(request))
+                except OSError:
+                    self._disconnect(self.ch)
+            reconnect = self.ch is None and self._start_reconnect()
+        if reconnect:
+            self._reconnect()
+        return fut
+
     def command(self, name, *args):
+        return self.submit(name, *args).result()
+
+    # The methods below must be called with _lock held
+    def _new_session_write(self):
+        # (client id, seq, acked) for a new write
+        seq = next(self._seqs)
+        self._unanswered.add(seq)
+        while self._acked + 1 not in self._unanswered:
+            self._acked += 1
+        return (self.client_id, seq, self._acked)
+
+    def _start_reconnect(self):
+        # True if the caller is to reconnect (call _reconnect() once
+        # _lock is released).  Only one thread reconnects at a time
+        if self._connecting:
+            return False
+        self._connecting = True
+        return True
+
+    def _disconnect(self, ch):
+        if self.ch is ch:
+            self.ch = None
+        ch.sock.close()
+
+    def _reconnect(self):
+        # Connect to the leader and send everything still unanswered.
+        # Called without _lock.  Finding the leader can take a while and
+        # other threads keep submitting meanwhile.  Their requests wait
+        # in _pending and go out with the rest once the new connection
+        # is in place.
+        while True:
+            ch, leader = self._connect()
+            with self._lock:
+                self.ch = ch
+                self.leader = leader
+                threading.Thread(target=self._read_responses, args=(ch,), daemon=True).start()
+                try:
+                    for req_id, (fut, request) in sorted(self._pending.items()):
+                        ch.send(pickle.dumps(request))
+                except OSError:
+                    self._disconnect(ch)
+                    continue
+                self._connecting = False
+                return
+
+    # Thread that reads the responses from one connection
+    def _read_responses(self, ch):
         while True:
-            if self.ch is None:
-                self._connect()
             try:
-                self.ch.send(self.encode_command(name, *args))
-                return self.decode_response(self.ch.recv())
-            except (OSError, pickle.PicklingError):
-                self.ch = None
+                req_id, status, result = pickle.loads(ch.recv())
+            except (OSError, ValueError, pickle.UnpicklingError):
+                status, result = 'closed', None
+            if status in { 'redirect', 'closed' }:
+                # No longer the leader (nothing was done) or the
+                # connection is gone.  Try again with the leader.
+                with self._lock:
+                    if self.ch is not ch:
+                        return        # Already replaced
+                    if status == 'redirect':
+                        self.leader = result
+                    self._disconnect(ch)
+                    reconnect = self._pending and self._start_reconnect()
+                if reconnect:
+                    self._reconnect()
+                return
+            with self._lock:
+                fut, request = self._pending.pop(req_id, (None, None))
+                if request and len(request) == 4:
+                    self._unanswered.discard(request[3][1])
+            if fut:
+                if status == 'ok':
+                    fut.set_result(result)
+                else:
+                    fut.set_exception(KVError(result))
+
+    def read_command(self, name, *args):
+        # Command for read_server.  Errors aren't retried.
+        if self.read_ch is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(KV_SERVER_CONFIG[self.read_server])
+            self.read_ch = Channel(sock)
+            self.read_ch.recv()    # 'ok' or 'follower'.  Either will do
+        try:
+            self.read_ch.send(self.encode_command(name, *args))
+            return self.decode_response(self.read_ch.recv())
+        except OSError:
+            self.read_ch = None
+            raise
 
-    def get(self, key):
-        return self.command('get', key)
+    def get(self, key, min_index=None, max_staleness=None):
+        # With no bounds the read is linearizable (served by the leader).
+        # Otherwise the value may be older, but reflects at least the log
+        # up to min_index (read your writes with min_index=self.last_index)
+        # and was current no more than max_staleness seconds ago.
+        if min_index is None and max_staleness is None:
+            return self.command('get', key)
+        if self.read_server is None:
+            return self.command('get', key, min_index, max_staleness)
+        return self.read_command('get', key, min_index, max_staleness)
 
     def set(self, key, value):
-        return self.command('set', key, value)
+        # Returns the log index of the write
+        return self.set_async(key, value).result()
+
+    # Several keys in one request.  mset takes a dict or (key, value)
+    # pairs.  mset and mdelete are a single write (all or nothing) and
+    # return its log index.  mget returns a list of values.
+    def mget(self, keys, min_index=None, max_staleness=None):
+        keys = list(keys)
+        if min_index is None and max_staleness is None:
+            return self.command('mget', keys)
+        if self.read_server is None:
+            return self.command('mget', keys, min_index, max_staleness)
+        return self.read_command('mget', keys, min_index, max_staleness)
+
+    def mset(self, items):
+        return self.mset_async(items).result()
+
+    def mdelete(self, keys):
+        return self.mdelete_async(keys).result()
+
+    # Versions that don't wait.  They return Futures
+    def get_async(self, key):
+        return self.submit('get', key)
+
+    def set_async(self, key, value):
+        fut = self.submit('set', key, value)
+        fut.add_done_callback(self._note_index)
+        return fut
+
+    def mget_async(self, keys):
+        return self.submit('mget', list(keys))
+
+    def mset_async(self, items):
+        items = list(items.items() if isinstance(items, dict) else items)
+        fut = self.submit('mset', items)
+        fut.add_done_callback(self._note_index)
+        return fut
+
+    def mdelete_async(self, keys):
+        fut = self.submit('mdelete', list(keys))
+        fut.add_done_callback(self._note_index)
+        return fut
+
+    def _note_index(self, fut):
+        if not fut.exception():
+            self.last_index = max(self.last_index, fut.result())
 
 if __name__ == '__main__':
     client = KVClient()
@@ -3,16 +3,39 @@ import pickle
 import threading
 import time
 import socket
+import concurrent.futures
+import queue
+from collections import OrderedDict
 
 from .channel import Channel
-from .dispatcher import ChannelDispatcher
-from .control import RaftController
+from .control import NotLeaderError
+from .server import make_controller
+from .storage import make_storage
 from .machine import RaftMachine, Leader
+from .timers import get_timer_service
 from .config import *
 
+class Session:
+    __slots__ = ('time', 'acked', 'results')
+
+    def __init__(self, time):
+        self.time = time          # Last used
+        self.acked = 0            # Client has the results of writes up to here
+        self.results = { }        # seq -> result of writes after acked
+
 class KVStore:
-    def __init__(self):
+    def __init__(self, session_ttl=KV_SESSION_TTL, max_sessions=KV_MAX_SESSIONS):
         self.data = { }
+        self.lock = threading.Lock()    # So mget never sees half of a batch
+
+        # Client sessions, least recently used first.  They are part of
+        # the replicated state, so they're only changed by log entries
+        # and expire by the (leader's) times in the entries, never by
+        # this server's clock.
+        self.sessions = OrderedDict()
+        self.clock = 0.0
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
 
     def get(self, key):
         return self.data.get(key)
@@ -20,54 +43,259 @@ class KVStore:
     def set(self, key, value):
         self.data[key] = value
 
+    def mget(self, keys):
+        with self.lock:
+            return [ self.data.get(key) for key in keys ]
+
+    def apply_batch(self, ops):
+        # ops is a list of ('set', key, value) and ('delete', key)
+        with self.lock:
+            for op, key, *value in ops:
+                if op == 'set':
+                    self.data[key] = value[0]
+                else:
+                    self.data.pop(key, None)
+
+    def check_session(self, client, seq, acked, t, index):
+        # Write number seq of a client, at log index.  Returns None if
+        # it's new (and should be applied) or the result to give instead
+        self.clock = max(self.clock, t)
+        session = self.sessions.get(client)
+        if session is None:
+            if acked:
+                # Had a session once.  Its writes may or may not have
+                # been applied and there's no way to tell
+                return ('error', 'Session expired')
+            session = self.sessions[client] = Session(self.clock)
+        else:
+            session.time = self.clock
+            self.sessions.move_to_end(client)
+        if acked > session.acked:
+            # Results are (almost always) in seq order
+            results = session.results
+            while results and next(iter(results)) <= acked:
+                del results[next(iter(results))]
+            session.acked = acked
+        self.expire_sessions()
+        if seq <= session.acked:
+            return ('error', 'Duplicate request')
+        if seq in session.results:
+            return session.results[seq]
+        session.results[seq] = ('ok', index)
+        return None
+
+    def expire_sessions(self):
+        while self.sessions:
+            client, session = next(iter(self.sessions.items()))
+            if (len(self.sessions) <= self.max_sessions
+                and session.time >= self.clock - self.session_ttl):
+                break
+            del self.sessions[client]
+
+    def snapshot(self):
+        return pickle.dumps((self.data, self.sessions, self.clock))
+
+    def restore(self, data):
+        state = pickle.loads(data)
+        if isinstance(state, dict):
+            # Snapshot from before sessions
+            state = (state, OrderedDict(), 0.0)
+        self.data, self.sessions, self.clock = state
+
 class KVServer:
     def __init__(self, control):
         self.control = control
         self.control.applicator = self.apply_entries
+        self.control.snapshotter = self.store_snapshot
+        self.control.restorer = self.restore_snapshot
         self.store = KVStore()
-        self.write_lock = threading.Lock()
-        self.commit_evt = threading.Event()
-
-    def apply_entries(self, entries):
-        print("KVSTORE: applying entries", entries)
-        for ent in entries:
-            key, value = ent.entry
-            self.store.set(key, value)
-        self.commit_evt.set()
-
-    def do_command(self, msg):
-        # This could be executed by multiple client threads
-        name, args = pickle.loads(msg)
-        print(name, args)
-        if name == 'get':
-            # Gets run immediately
-            result = ('ok', self.store.get(*args))
-        elif name == 'set':
-            # Set operations involve raft
-            key, value = args
-            with self.write_lock:
-                # Only one write at a time
-                self.commit_evt.clear()
-                self.control.append_entry((key, value))
-                self.commit_evt.wait()
-            result = ('ok', None)
+        if self.control.machine.snapshot is not None:
+            # Recovered from storage on restart
+            self.store.restore(self.control.machine.snapshot)
+
+    def apply_entries(self, entries, index):
+        # Returns the result of each entry.  None is success for writes
+        # made without a session (the result is the entry's index)
+        self.control.debug_log.debug('KVSTORE: applying entries %s', entries)
+        results = [ ]
+        for n, ent in enumerate(entries):
+            entry = ent.entry
+            if isinstance(entry, dict):
+                # Write made in a client session (see start_command)
+                result = self.store.check_session(entry['client'], entry['seq'], entry['acked'],
+                                                  entry['time'], index + n)
+                results.append(result)
+                if result is not None:
+                    continue  # Duplicate.  Already applied
+                entry = entry['op']
+            else:
+                results.append(None)
+            if entry is None:
+                continue      # No-op added by the leader
+            if isinstance(entry, list):
+                # Batch of writes (mset/mdelete).  One entry, all applied
+                # together
+                self.store.apply_batch(entry)
+            else:
+                key, value = entry
+                self.store.set(key, value)
+        return results
+
+    def store_snapshot(self):
+        return self.store.snapshot()
+
+    def restore_snapshot(self, data):
+        print("KVSTORE: restoring snapshot")
+        self.store.restore(data)
+
+    # Commands don't block.  start_command() arranges for reply() to be
+    # called with the (status, result) of the command when it's done
+    # (possibly right away, possibly from another thread).  Any number of
+    # commands can be in progress at once.
+    #
+    # Writes can be made in a client session, (client id, seq, acked).
+    # seq numbers the client's writes (from 1).  The client has the
+    # results of all of its writes up to acked.  A write whose seq has
+    # been seen before isn't applied again.  It gets the first result.
+    def start_command(self, name, args, reply, session=None):
+        if self.needs_leader(name, args) and self.control.machine.state != Leader:
+            # Tell the client where to go
+            reply(('redirect', self.control.machine.leaderId))
+        elif name == 'get':
+            key, *bounds = args
+            self.start_read(reply, lambda: self.store.get(key), *bounds)
+        elif name == 'mget':
+            keys, *bounds = args
+            self.start_read(reply, lambda: self.store.mget(keys), *bounds)
+        elif name in { 'set', 'mset', 'mdelete' }:
+            # Set operations involve raft.  The result is the log index of
+            # the write.  Reads given that index as min_index are sure to
+            # see it.  mset and mdelete are one entry however many keys
+            # they have.
+            if name == 'set':
+                entry = tuple(args)
+            elif name == 'mset':
+                entry = [ ('set', key, value) for key, value in args[0] ]
+            else:
+                entry = [ ('delete', key) for key in args[0] ]
+            if session:
+                client, seq, acked = session
+                entry = { 'client': client, 'seq': seq, 'acked': acked,
+                          'time': time.time(), 'op': entry }
+            fut = self.control.append_entry(entry)
+            fut.add_done_callback(lambda fut: reply(self.write_result(fut, session)))
         else:
-            result = ('error', f'Unknown command: {name}')
-        return pickle.dumps(result)
+            reply(('error', f'Unknown command: {name}'))
+
+    def write_result(self, fut, session=None):
+        try:
+            result = fut.result()
+            return ('ok', fut.index) if result is None else result
+        except NotLeaderError as e:
+            if session:
+                # The write may or may not have happened.  The client
+                # sends it again (same seq) to the leader, which applies
+                # it only if it didn't
+                return ('redirect', self.control.machine.leaderId)
+            return ('error', str(e))
+        except TypeError as e:
+            return ('error', str(e))
+
+    def needs_leader(self, name, args):
+        # Everything but gets with bounds (see start_read)
+        return name not in { 'get', 'mget' } or len(args) == 1 or args[1:] == (None, None)
+
+    def start_read(self, reply, read, min_index=None, max_staleness=None):
+        # Reply with read() (get or mget)
+        if self.control.machine.state is Leader or (min_index is None and max_staleness is None):
+            # Gets are served by the leader once it has confirmed that it
+            # is still the leader and has applied every committed write
+            # (ReadIndex).  Gets arriving together share one confirmation.
+            # A leader holding a read lease doesn't need to check.
+            if self.control.has_lease():
+                reply(('ok', read()))
+            else:
+                self.control.read_index().add_done_callback(
+                    lambda fut: reply(('error', str(fut.exception())) if fut.exception()
+                                      else ('ok', read())))
+            return
+
+        # Followers serve gets that say how old an answer may be.  Wait
+        # a little while for this server to catch up if it has to.
+        futs = [ ]
+        if min_index is not None:
+            futs.append(self.control.wait_applied(min_index))
+        if max_staleness is not None:
+            futs.append(self.control.wait_fresh(max_staleness))
+        timer = get_timer_service().call_later(FOLLOWER_READ_TIMEOUT,
+                                               lambda: [ fut.cancel() for fut in futs ])
+        remaining = set(futs)
+        lock = threading.Lock()
+        def done(fut):
+            with lock:
+                if not remaining:
+                    return          # Already replied
+                if fut.cancelled():
+                    remaining.clear()
+                    result = ('error', f'Server {self.control.addr} is behind')
+                else:
+                    remaining.discard(fut)
+                    if remaining:
+                        return
+                    timer.cancel()
+                    result = ('ok', read())
+            reply(result)
+        for fut in futs:
+            fut.add_done_callback(done)
 
     def handle_client(self, sock):
-        # This handles the processing of a single client
+        # This handles the processing of a single client.  Requests are
+        # (id, name, args) or (id, name, args, session) and responses
+        # (id, status, result), sent as each command finishes.  A separate thread sends them so the
+        # Raft controller (which completes most commands) never waits on
+        # a client.  Requests without an id, (name, args), are handled
+        # one at a time with responses (status, result).
         with sock:
             ch = Channel(sock)
-            if self.control.machine.state != Leader:
-                ch.send(pickle.dumps('error'))
-                return
-            else:
+            # Followers take connections for reads only.  Clients wanting
+            # the leader are told which server it is (if known).
+            if self.control.machine.state == Leader:
                 ch.send(pickle.dumps('ok'))
+            else:
+                ch.send(pickle.dumps(('follower', self.control.machine.leaderId)))
+            responses = queue.Queue()
+            threading.Thread(target=self.send_responses, args=(ch, responses), daemon=True).start()
+            try:
                 while True:
-                    msg = ch.recv()   # Get a message
-                    ch.send(self.do_command(msg))
-            
+                    request = pickle.loads(ch.recv())
+                    if len(request) >= 3:
+                        req_id, name, args, *session = request
+                        self.start_command(name, args,
+                                           lambda result, req_id=req_id: responses.put((req_id, *result)),
+                                           *session)
+                    else:
+                        name, args = request
+                        done = concurrent.futures.Future()
+                        self.start_command(name, args, done.set_result)
+                        try:
+                            responses.put(done.result(KV_REQUEST_TIMEOUT))
+                        except concurrent.futures.TimeoutError:
+                            responses.put(('error', 'Request timed out'))
+            except (OSError, ValueError, pickle.UnpicklingError):
+                pass          # Client went away
+            finally:
+                responses.put(None)
+
+    def send_responses(self, ch, responses):
+        while True:
+            response = responses.get()
+            if response is None:
+                return
+            try:
+                ch.send(pickle.dumps(response))
+            except OSError:
+                return
+
     def run_server(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
@@ -82,18 +310,16 @@ class KVServer:
     def start(self):
         threading.Thread(target=self.run_server, daemon=True).start()
 
-def main(addr):
-    dispatch = ChannelDispatcher(addr)
-    dispatch.start()
-    controller = RaftController(addr, dispatch, RaftMachine())
-    controller.start()
+def main(addr, runtime=RAFT_RUNTIME):
+    controller = make_controller(addr, RaftMachine(storage=make_storage(addr)), runtime)
     kvserver = KVServer(controller)
+    controller.start()
     kvserver.start()
     return kvserver
     
 if __name__ == '__main__':
     import sys
-    server = main(int(sys.argv[1]))
+    server = main(int(sys.argv[1]), *sys.argv[2:3])
     while True:
         time.sleep(1)
 
@@ -2,42 +2,282 @@
 #
 # The Raft state machine
 
-from .message import RequestVote, RequestVoteResponse, AppendEntries, AppendEntriesResponse
+from collections import deque
+
+from .message import (RequestVote, RequestVoteResponse, AppendEntries, AppendEntriesResponse,
+                      InstallSnapshot, InstallSnapshotResponse)
+from .storage import MemoryStorage
+from .config import (SNAPSHOT_THRESHOLD, SNAPSHOT_CHUNK_SIZE, MAX_INFLIGHT_APPENDS,
+                     MAX_APPEND_ENTRIES, MAX_APPEND_BYTES, QUORUM_WEIGHTS, QUORUM_SIZE,
+                     APPEND_BATCH_DELAY, APPEND_BATCH_ENTRIES, READ_LEASE, CLOCK_DRIFT_BOUND,
+                     ELECTION_TIMEOUT)
+from .quorum import QuorumTracker
+from . import codec
 
 class LogEntry:
-    def __init__(self, term, entry):
+    __slots__ = ('term', '_entry', '_payload')
+
+    # Entries received from the leader arrive as the payload only.  The
+    # item isn't decoded until something looks at it (normally when the
+    # entry is applied)
+    UNDECODED = object()
+
+    def __init__(self, term, entry, payload=None):
         self.term = term
-        self.entry = entry
+        self._entry = entry
+        self._payload = payload
     def __repr__(self):
         return f'LogEntry({self.term}, {self.entry})'
     def __eq__(self, other):
         return (self.term, self.entry) == (other.term, other.entry)
+    def __reduce__(self):
+        if self._entry is LogEntry.UNDECODED:
+            return (entry_from_payload, (self.term, self._payload))
+        return (LogEntry, (self.term, self._entry))
+
+    @property
+    def entry(self):
+        if self._entry is LogEntry.UNDECODED:
+            self._entry = codec.decode_value(self._payload)
+        return self._entry
+
+    # The entry encoded for the wire.  Computed once no matter how many
+    # times (or to how many followers) the entry is sent
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = codec.encode_value(self._entry)
+        return self._payload
+
+def entry_from_payload(term, payload):
+    return LogEntry(term, LogEntry.UNDECODED, payload)
+
+# The log.  Entries up to and including snapshotIndex have been discarded
+# (they're captured by a snapshot).  All indexing is by absolute log index
+# so code using the log doesn't care how much of it has been compacted.
+class RaftLog:
+    def __init__(self, entries=(), snapshotIndex=-1, snapshotTerm=-1):
+        self.entries = list(entries)
+        self.snapshotIndex = snapshotIndex
+        self.snapshotTerm = snapshotTerm
+
+    def __repr__(self):
+        return f'RaftLog(snapshotIndex={self.snapshotIndex}, snapshotTerm={self.snapshotTerm}, entries={self.entries})'
+
+    def __len__(self):
+        # One past the last log index
+        return self.snapshotIndex + 1 + len(self.entries)
+
+    def _position(self, index):
+        if index < 0:
+            index += len(self)
+        if index <= self.snapshotIndex:
+            raise IndexError(f'Log index {index} has been compacted')
+        return index - self.snapshotIndex - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # log[start:stop].  Omitting start means the first entry retained
+            start = index.start if index.start is not None else self.snapshotIndex + 1
+            stop = index.stop if index.stop is not None else len(self)
+            if start >= stop:
+                return []
+            return self.entries[self._position(start):stop-self.snapshotIndex-1]
+        return self.entries[self._position(index)]
+
+    def __setitem__(self, index, entries):
+        # Only log[index:] = entries (replace the end of the log) is allowed
+        assert isinstance(index, slice) and index.stop is None and index.step is None
+        start = index.start if index.start is not None else self.snapshotIndex + 1
+        self.entries[self._position(start):] = entries
+
+    def entries_from(self, index, max_entries, max_bytes):
+        # Entries starting at index, limited in number and encoded size.
+        # At least one entry is returned (if there are any) no matter how
+        # big.  Only the returned entries are copied.
+        start = self._position(index)
+        stop = min(start + max_entries, len(self.entries))
+        size = 0
+        for pos in range(start, stop):
+            size += len(self.entries[pos].payload)
+            if size > max_bytes and pos > start:
+                stop = pos
+                break
+        return self.entries[start:stop]
+
+    def append(self, entry):
+        self.entries.append(entry)
+
+    def extend(self, entries):
+        self.entries.extend(entries)
+
+    def term_at(self, index):
+        if index == self.snapshotIndex:
+            return self.snapshotTerm
+        return self[index].term if index >= 0 else -1
+
+    def _search_term(self, term, after):
+        # Position of the first entry with a term > term (after=True) or
+        # >= term (after=False).  Terms never decrease along the log.
+        lo, hi = 0, len(self.entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self.entries[mid].term
+            if t < term or (after and t == term):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def first_index_of_term(self, term):
+        # First retained index with the given term (None if none)
+        pos = self._search_term(term, False)
+        if pos < len(self.entries) and self.entries[pos].term == term:
+            return pos + self.snapshotIndex + 1
+        return None
+
+    def last_index_of_term(self, term):
+        # Last retained index with the given term (None if none)
+        pos = self._search_term(term, True) - 1
+        if pos >= 0 and self.entries[pos].term == term:
+            return pos + self.snapshotIndex + 1
+        return None
+
+    def compact(self, index):
+        # Discard entries up to and including index
+        self.snapshotTerm = self.term_at(index)
+        del self.entries[:index-self.snapshotIndex]
+        self.snapshotIndex = index
+
+    def reset(self, index, term):
+        # Discard the entire log.  It starts over after index
+        self.entries = []
+        self.snapshotIndex = index
+        self.snapshotTerm = term
 
 class RaftMachine:
-    def __init__(self, control=None):
+    def __init__(self, control=None, storage=None):
         self.control = control   # All configuration/system dependent details in control
 
-        self.term = 0            # Must be a persistent value (Eventually)
+        # Persistent state (term, votedFor, log) is recovered from storage.
+        # Changes to it are recorded there as they are made.
+        self.storage = storage if storage is not None else MemoryStorage()
+        self._term, self._votedFor, snapshot, entries = self.storage.load()
         self.state = Follower    
-        self.votedFor = None     # Who voted for in current term
-
-        self.log = [ ]           # Persistent data.  Part of controller?
 
         # Volatile state (on all servers)
         self.commitIndex = -1     # Highest log entry known to be committed
         self.lastApplied = -1     # Highest log entry applied to state machine
 
+        # Snapshot of the applied state covering the compacted log prefix.
+        # The application restores it from here on restart.
+        self.snapshot = None
+        self.snapshotThreshold = SNAPSHOT_THRESHOLD
+        self.snapshotChunkSize = SNAPSHOT_CHUNK_SIZE
+        self.snapshotReceive = None   # (index, bytearray) being received
+
+        # Max number of AppendEntries a leader pipelines to each follower
+        # and the max number of entries and bytes of entries in each one
+        self.maxInflight = MAX_INFLIGHT_APPENDS
+        self.maxAppendEntries = MAX_APPEND_ENTRIES
+        self.maxAppendBytes = MAX_APPEND_BYTES
+
+        # Leader batching of new entries.  New entries are held for up to
+        # batchDelay seconds (or until batchEntries of them accumulate) and
+        # then go out together in one AppendEntries per follower.  0 sends
+        # every entry right away.
+        self.batchDelay = APPEND_BATCH_DELAY / 1e6
+        self.batchEntries = APPEND_BATCH_ENTRIES
+
+        # Leader reads in progress (ReadIndex, section 6.4 of Ongaro's thesis).
+        # Each read gets a read index and waits for a round of heartbeats
+        # to be acknowledged by a quorum.  Reads arriving while a round is
+        # out wait together for the next one.  Then they wait for
+        # lastApplied to reach their read index.
+        self.readWaiting = [ ]        # (index, token) for the next round
+        self.readRound = None         # (seq, [(index, token), ...]) in progress
+        self.readReady = deque()      # (index, token) waiting to be applied
+
+        # Lease reads (section 6.4.1).  A leader that has heard from a
+        # quorum within the last leaseTime seconds can read its applied
+        # state with no messages at all.  This relies on servers not
+        # voting for anyone else within ELECTION_TIMEOUT of hearing from
+        # the leader (leaderRecent).  CLOCK_DRIFT_BOUND covers the clocks
+        # running at different rates.
+        self.leaseReads = READ_LEASE
+        self.leaseTime = ELECTION_TIMEOUT - CLOCK_DRIFT_BOUND
+        self.leaseExpires = 0
+        self.leaderRecent = False     # Heard from leader since the last election timeout
+
+        # Server believed to be the current leader (None if unknown).
+        # Clients are sent there.
+        self.leaderId = None
+
+        # Follower reads.  Clock time when the applied state last caught
+        # up with the commitIndex of the leader
+        self.caughtUp = None
+        if snapshot:
+            index, term, self.snapshot = snapshot
+            self.log = RaftLog(entries, index, term)
+            self.commitIndex = self.lastApplied = index
+        else:
+            self.log = RaftLog(entries)
+
+    @property
+    def term(self):
+        return self._term
+
+    @term.setter
+    def term(self, term):
+        if term != self._term:
+            self._term = term
+            self.storage.save_state(term, self._votedFor)
+
+    @property
+    def votedFor(self):
+        # Who voted for in current term
+        return self._votedFor
+
+    @votedFor.setter
+    def votedFor(self, votedFor):
+        if votedFor != self._votedFor:
+            self._votedFor = votedFor
+            self.storage.save_state(self._term, votedFor)
+
     # Transactions on the state machine.  These represent actions that need to
     # result in persistent state and logged.
+    def log_matches(self, index, term):
+        # Does the log contain an entry at index with the given term?
+        if index <= self.log.snapshotIndex:
+            return True    # Compacted entries are committed. They match.
+        return index < len(self.log) and self.log.term_at(index) == term
+
     def append_entries(self, previndex, prevterm, entries):
         assert all(isinstance(e, LogEntry) for e in entries)
-        if previndex + 1 > len(self.log):
+        if not self.log_matches(previndex, prevterm):
             return False
-        if previndex >= 0 and self.log[previndex].term != prevterm:
-            return False
-        self.log[previndex+1:] = entries
+        if previndex < self.log.snapshotIndex:
+            # Skip entries already covered by the snapshot
+            entries = entries[self.log.snapshotIndex-previndex:]
+            previndex = self.log.snapshotIndex
+        # Skip entries already in the log.  The log is only cut back at
+        # the first entry with a conflicting term.  A duplicated or
+        # reordered AppendEntries must not remove anything.
+        index = previndex + 1
+        for n, e in enumerate(entries):
+            if index + n >= len(self.log) or self.log.term_at(index + n) != e.term:
+                self.log[index+n:] = entries[n:]
+                self.storage.append(index+n, entries[n:])
+                break
         return True
     
+    def new_quorum(self):
+        # Tracks the highest value (log index, read round, vote) reported
+        # by a quorum of servers.  Elections, commits and reads all use
+        # the same weights, so any two quorums overlap.
+        return QuorumTracker([self.control.addr, *self.control.peers],
+                             QUORUM_WEIGHTS, QUORUM_SIZE)
+
     def reset_leader(self):
         # On becoming leader, these values are reset.
 
@@ -46,15 +286,49 @@ class RaftMachine:
 
         # Match index is the highest known index for matching logs
         self.matchIndex = { peer: -1 for peer in self.control.peers }
-        
-        # Who voted for in current election
-        self.votedFor = None
+
+        # Highest index stored on a quorum (including this server)
+        self.quorum = self.new_quorum()
+
+        # Byte offset of the next snapshot chunk to send to each peer
+        self.snapshotOffset = { peer: 0 for peer in self.control.peers }
+
+        # Replication to each follower starts out probing for the point
+        # where the logs match, one AppendEntries at a time.  Once found,
+        # up to maxInflight AppendEntries are pipelined with nextIndex
+        # advanced as they're sent (not when the response arrives).
+        # inflight holds the last log index of each unacknowledged message
+        self.probing = { peer: True for peer in self.control.peers }
+        self.inflight = { peer: deque() for peer in self.control.peers }
+
+        # matchIndex of each follower at the last leader timeout if it
+        # had messages in flight then (see check_inflight())
+        self.inflightMatch = { peer: None for peer in self.control.peers }
+
+        # Index of the first new entry being held for batching (None if
+        # nothing is held)
+        self.heldFrom = None
+
+        # Read rounds (see read_index()).  readSeq goes out with every
+        # AppendEntries and comes back in the response
+        self.readSeq = 0
+        self.readQuorum = self.new_quorum()
+        self.readSent = { }           # readSeq -> clock when sent (lease reads)
+        self.leaseExpires = 0
+        # votedFor stays as is (this server).  It's on disk, and clearing
+        # it would let a leader that restarts vote again in the same term
 
     # Generic dispatch for any message
     def handle_Message(self, msg):
+        if msg.term > self.term and type(msg) is RequestVote and self.ignore_votes():
+            return
         if msg.term > self.term:
+            if self.state is Leader:
+                self.fail_reads()
+                self.control.leader_lost()
             self.term = msg.term
             self.state = Follower
+            self.leaderId = None
             self.votedFor = None
         getattr(self, f'handle_{type(msg).__name__}')(msg)
 
@@ -66,6 +340,13 @@ class RaftMachine:
         if msg.term == self.term:
             self.state.handle_AppendEntriesResponse(self, msg)
 
+    def handle_InstallSnapshot(self, msg):
+        self.state.handle_InstallSnapshot(self, msg)
+
+    def handle_InstallSnapshotResponse(self, msg):
+        if msg.term == self.term:
+            self.state.handle_InstallSnapshotResponse(self, msg)
+
     def handle_RequestVote(self, msg):
         self.state.handle_RequestVote(self, msg)
 
@@ -75,38 +356,273 @@ class RaftMachine:
 
     # Different timeouts
     def handle_ElectionTimeout(self):
+        self.leaderRecent = False
         self.state.handle_ElectionTimeout(self)
 
     def handle_LeaderTimeout(self):
         self.state.handle_LeaderTimeout(self)
 
-    # Function to add a new entry to the log and initiate an AppendEntries
+    # Function to add a new entry to the log and initiate an AppendEntries.
+    # Returns the index of the new entry.  item must be something the
+    # codec can encode (see codec.py)
     def append_new_entry(self, item):
         e = LogEntry(self.term, item)
+        e.payload     # TypeError (with nothing logged) if item can't be encoded
+        self.storage.append(len(self.log), [e])
         self.log.append(e)
-        self.send_AppendEntries()
-        self.control.reset_leader_timeout()
+        self.update_commit()
+        if self.batchDelay and self.heldFrom is None:
+            self.heldFrom = len(self.log) - 1
+            self.control.schedule_flush(self.batchDelay)
+        if not self.batchDelay or len(self.log) - self.heldFrom >= self.batchEntries:
+            self.flush_NewEntries()
+        return len(self.log) - 1
+
+    def flush_NewEntries(self):
+        # Send the entries held for batching.  Also called by the
+        # controller when the batch delay expires.  The leader timeout
+        # isn't reset.  It ticks regularly however busy the leader is, so
+        # followers with a full window still get heartbeats and lost
+        # windows are noticed (see check_inflight())
+        self.heldFrom = None
+        if self.state is Leader:
+            self.send_NewEntries()
+
+    @property
+    def sendLimit(self):
+        # Entries before this index can be sent
+        return len(self.log) if self.heldFrom is None else self.heldFrom
+
+    def update_commit(self):
+        # Leader: commit whatever a quorum has stored.  Only entries from
+        # the current term are committed by counting replicas (pg. 8-9).
+        # Earlier entries get committed along with them.
+        index = self.quorum.update(self.control.addr, len(self.log) - 1)
+        if index > self.commitIndex and self.log.term_at(index) == self.term:
+            self.commitIndex = index
+            self.apply_committed()
 
     def send_AppendEntries(self):
         # Send an AppendEntries message to all peers
         for dest in self.control.peers:
             self.send_AppendEntry(dest)
 
+    def send_NewEntries(self):
+        # Send unsent entries to all peers with room in their window
+        for dest in self.control.peers:
+            self.send_Pipelined(dest)
+
+    def send_Pipelined(self, dest):
+        # Keep sending to one server until its window is full.  While
+        # probing, the next message goes out when a response arrives
+        while (not self.probing[dest] and
+               self.nextIndex[dest] < self.sendLimit and
+               len(self.inflight[dest]) < self.maxInflight):
+            self.send_AppendEntry(dest)
+
+    def check_inflight(self):
+        # Called on every leader timeout.  Pipelined AppendEntries can be
+        # lost (dispatchers drop messages to servers that are down) and
+        # heartbeats go out at matchIndex, so they succeed without
+        # showing it.  If a follower's matchIndex hasn't moved in a whole
+        # leader timeout with messages in flight, they're taken as lost.
+        # The window is rolled back and probing starts over from matchIndex.
+        for peer in self.control.peers:
+            if self.inflight[peer] and self.inflightMatch[peer] == self.matchIndex[peer]:
+                self.inflight[peer].clear()
+                self.nextIndex[peer] = self.matchIndex[peer] + 1
+                self.probing[peer] = True
+            self.inflightMatch[peer] = self.matchIndex[peer] if self.inflight[peer] else None
+
     def send_AppendEntry(self, dest):
         # Send a single AppendEntry message to one server
-        prevLogIndex = self.nextIndex[dest] - 1
-        prevLogTerm = self.log[prevLogIndex].term if prevLogIndex >= 0 else -1
+        if not self.probing[dest] and len(self.inflight[dest]) >= self.maxInflight:
+            # Window full.  Send a heartbeat that's known to match
+            prevLogIndex = max(self.matchIndex[dest], self.log.snapshotIndex)
+            entries = []
+        else:
+            prevLogIndex = self.nextIndex[dest] - 1
+            if prevLogIndex < self.log.snapshotIndex:
+                # Entries needed by the follower are gone. Send the snapshot
+                self.send_InstallSnapshot(dest)
+                return
+            entries = self.log.entries_from(prevLogIndex+1,
+                                            min(self.maxAppendEntries, self.sendLimit - prevLogIndex - 1),
+                                            self.maxAppendBytes)
+            if entries and not self.probing[dest]:
+                self.nextIndex[dest] += len(entries)
+                self.inflight[dest].append(self.nextIndex[dest] - 1)
+            elif not entries and not self.probing[dest]:
+                # Heartbeat.  Heartbeats can overtake the AppendEntries
+                # in flight (they go by a separate connection, see
+                # dispatcher.py), so they go out at the last known match
+                prevLogIndex = max(self.matchIndex[dest], self.log.snapshotIndex)
         self.control.send_message(
             AppendEntries(
                 dest=dest,
                 term=self.term,
                 prevLogIndex=prevLogIndex,
-                prevLogTerm=prevLogTerm,
-                entries=self.log[prevLogIndex+1:],
-                leaderCommit=self.commitIndex
+                prevLogTerm=self.log.term_at(prevLogIndex),
+                entries=entries,
+                leaderCommit=self.commitIndex,
+                readSeq=self.readSeq
                 )
             )
 
+    def conflict_hint(self, index):
+        # Where a leader should back up to when its AppendEntries with
+        # prevLogIndex=index doesn't match.  Returns (conflictTerm,
+        # conflictIndex): the term of our entry at index and the first
+        # index holding that term, or (-1, len(log)) if the log is too short
+        if index >= len(self.log):
+            return -1, len(self.log)
+        term = self.log.term_at(index)
+        first = self.log.first_index_of_term(term)
+        return term, first if first is not None else self.log.snapshotIndex + 1
+
+    def next_from_conflict(self, msg):
+        # Leader side of conflict_hint().  If we have entries from the
+        # conflicting term, resume after the last of them.  Otherwise skip
+        # the follower's entire run of that term.
+        if msg.conflictTerm >= 0:
+            last = self.log.last_index_of_term(msg.conflictTerm)
+            if last is not None:
+                return last + 1
+        return msg.conflictIndex
+
+    def send_InstallSnapshot(self, dest):
+        # Send the next chunk of the snapshot to one server
+        offset = self.snapshotOffset[dest]
+        data = self.snapshot[offset:offset+self.snapshotChunkSize]
+        self.control.send_message(
+            InstallSnapshot(
+                dest=dest,
+                term=self.term,
+                lastIncludedIndex=self.log.snapshotIndex,
+                lastIncludedTerm=self.log.snapshotTerm,
+                offset=offset,
+                data=data,
+                done=offset+len(data) >= len(self.snapshot)
+                )
+            )
+
+    # Apply newly committed entries to the application state
+    def apply_committed(self):
+        if self.lastApplied < self.commitIndex:
+            self.control.apply_entries(self.log[self.lastApplied+1:self.commitIndex+1],
+                                       self.lastApplied+1)
+            self.lastApplied = self.commitIndex
+            if self.lastApplied - self.log.snapshotIndex >= self.snapshotThreshold:
+                self.take_snapshot()
+            if self.state is Leader:
+                self.serve_reads()
+
+    # Leader: linearizable read.  token is anything.  Once it is safe to
+    # read the applied state, control.read_ready(token, index) is called.
+    # If leadership is lost first, control.read_failed(token) is called.
+    def read_index(self, token):
+        first = self.log.first_index_of_term(self.term)
+        if first is None:
+            # Entries committed by earlier leaders may not be known to be
+            # committed until one from this term is.  Add a no-op entry.
+            first = self.append_new_entry(None)
+        self.readWaiting.append((max(self.commitIndex, first), token))
+        if self.readRound is None:
+            self.start_read_round()
+
+    def start_read_round(self):
+        self.readRound = (self.next_read_seq(), self.readWaiting)
+        self.readWaiting = [ ]
+        self.check_reads()
+        if self.readRound:
+            self.send_AppendEntries()
+
+    def next_read_seq(self):
+        # Messages sent from now on confirm leadership as of now
+        self.readSeq += 1
+        if self.leaseReads:
+            self.readSent[self.readSeq] = self.control.clock()
+        self.readQuorum.update(self.control.addr, self.readSeq)
+        return self.readSeq
+
+    def check_reads(self):
+        # Called when a quorum may have acknowledged a read round
+        if self.readSent and self.readQuorum.index in self.readSent:
+            # The lease runs from when the acknowledged round started
+            self.leaseExpires = self.readSent[self.readQuorum.index] + self.leaseTime
+            for seq in [ seq for seq in self.readSent if seq <= self.readQuorum.index ]:
+                del self.readSent[seq]
+        if self.readRound and self.readQuorum.index >= self.readRound[0]:
+            self.readReady.extend(self.readRound[1])
+            self.readRound = None
+            if self.readWaiting:
+                self.start_read_round()
+            self.serve_reads()
+
+    def serve_reads(self):
+        # Reads are ready in order of read index
+        while self.readReady and self.readReady[0][0] <= self.lastApplied:
+            index, token = self.readReady.popleft()
+            self.control.read_ready(token, index)
+
+    def has_lease(self):
+        # Leader: can the applied state be read right now?  Everything
+        # committed by earlier leaders must be applied too (a committed
+        # entry from this term shows that it is).
+        return (self.state is Leader and self.control.clock() < self.leaseExpires and
+                self.log.term_at(self.lastApplied) == self.term)
+
+    def staleness(self):
+        # Follower: how long ago the applied state was known to be current
+        if self.caughtUp is None:
+            return float('inf')
+        return self.control.clock() - self.caughtUp
+
+    def ignore_votes(self):
+        # With lease reads, nobody may be elected while a leader could
+        # still hold a lease.  Servers that have heard from the leader
+        # within the election timeout (and the leader itself) ignore
+        # RequestVote (section 4.2.3)
+        if not self.leaseReads:
+            return False
+        if self.state is Leader:
+            return self.control.clock() < self.leaseExpires
+        return self.leaderRecent
+
+    def fail_reads(self):
+        reads = list(self.readReady) + self.readWaiting + (self.readRound[1] if self.readRound else [])
+        self.readReady.clear()
+        self.readWaiting = [ ]
+        self.readRound = None
+        for index, token in reads:
+            self.control.read_failed(token)
+
+    # Snapshot the applied state and discard the log prefix it covers
+    def take_snapshot(self):
+        data = self.control.create_snapshot()
+        if data is None:
+            return
+        self.log.compact(self.lastApplied)
+        self.snapshot = data
+        self.storage.save_snapshot(self.log.snapshotIndex, self.log.snapshotTerm,
+                                   data, self.log.entries)
+
+    # Replace the applied state (and possibly the log) with a snapshot
+    # received from the leader
+    def install_snapshot(self, index, term, data):
+        if index <= self.lastApplied:
+            return      # Already have everything in it
+        if self.log_matches(index, term) and index < len(self.log):
+            self.log.compact(index)   # Keep the entries that follow
+        else:
+            self.log.reset(index, term)
+        self.snapshot = data
+        self.storage.save_snapshot(index, term, data, self.log.entries)
+        self.control.restore_snapshot(data)
+        self.commitIndex = max(self.commitIndex, index)
+        self.lastApplied = index
+        self.apply_committed()
+
 class RaftState:
     @staticmethod
     def handle_AppendEntries(machine, msg):
@@ -118,9 +634,22 @@ class RaftState:
         pass
         # print('handle_AppendEntriesResponse not implemented')
 
+    @staticmethod
+    def handle_InstallSnapshot(machine, msg):
+        pass
+
+    @staticmethod
+    def handle_InstallSnapshotResponse(machine, msg):
+        pass
+
     @staticmethod
     def handle_RequestVote(machine, msg):
-        if (msg.term < machine.term or 
+        # Only vote for a candidate whose log is at least as up to date as
+        # ours (section 5.4.1).  Every committed entry is then on the
+        # log of whoever gets elected.
+        last = len(machine.log) - 1
+        logOk = (msg.lastLogTerm, msg.lastLogIndex) >= (machine.log.term_at(last), last)
+        if (msg.term < machine.term or not logOk or
             (msg.term == machine.term and 
              machine.votedFor is not None and
              machine.votedFor != msg.source)):
@@ -131,7 +660,7 @@ class RaftState:
                 )
             )
 
-        else: # This needs more work (there are issues with log being up to date)
+        else:
             machine.votedFor = msg.source
             machine.control.send_message(
                 RequestVoteResponse(dest=msg.source,
@@ -158,10 +687,12 @@ class Follower(RaftState):
     @staticmethod
     def handle_ElectionTimeout(machine):
         machine.state = Candidate
+        machine.leaderId = None
         machine.term += 1
         machine.votedFor = machine.control.addr   # I vote for myself
         machine.control.reset_election_timer()
-        machine.votesGranted = 1
+        machine.votes = machine.new_quorum()      # Servers that voted for me are at 0
+        machine.votes.update(machine.control.addr, 0)
 
         # Send a RequestVote to all other servers
         for dest in machine.control.peers:
@@ -169,27 +700,32 @@ class Follower(RaftState):
                 RequestVote(dest=dest,
                             term=machine.term,
                             lastLogIndex = len(machine.log) - 1,
-                            lastLogTerm = machine.log[len(machine.log)-1].term if machine.log else -1
+                            lastLogTerm = machine.log.term_at(len(machine.log)-1)
                             )
                 )
 
     @staticmethod
     def handle_AppendEntries(machine, msg):
-        machine.votedFor = None
-        logOk = (msg.prevLogIndex == -1 or (
-                     msg.prevLogIndex >= 0 and
-                     msg.prevLogIndex < len(machine.log) and
-                     msg.prevLogTerm == machine.log[msg.prevLogIndex].term
-                     )
-                 )
+        if msg.term == machine.term:
+            machine.leaderId = msg.source
+        logOk = machine.log_matches(msg.prevLogIndex, msg.prevLogTerm)
         if msg.term < machine.term or not logOk:
-            # Failure
+            # Failure.  The hint is only needed (and can only be worked
+            # out) if the log didn't match.  prevLogIndex may be compacted
+            if logOk:
+                conflictTerm, conflictIndex = -1, len(machine.log)
+            else:
+                conflictTerm, conflictIndex = machine.conflict_hint(msg.prevLogIndex)
             machine.control.send_message(
                 AppendEntriesResponse(
                     dest=msg.source,
                     term=machine.term,
                     success=False,
-                    matchIndex=-1
+                    matchIndex=-1,
+                    rejectIndex=msg.prevLogIndex,
+                    conflictTerm=conflictTerm,
+                    conflictIndex=conflictIndex,
+                    readSeq=msg.readSeq
                     )
                 )
         else:
@@ -204,39 +740,134 @@ class Follower(RaftState):
                     dest=msg.source,
                     term=machine.term,
                     success=True,
-                    matchIndex=msg.prevLogIndex+len(msg.entries)
+                    matchIndex=msg.prevLogIndex+len(msg.entries),
+                    readSeq=msg.readSeq
                     )
                 )
-            machine.commitIndex = msg.leaderCommit
-            if machine.lastApplied < machine.commitIndex:
-                machine.control.apply_entries(machine.log[machine.lastApplied+1:machine.commitIndex+1])
-                machine.lastApplied = machine.commitIndex
+            # Only entries known to match the leader can be committed
+            lastIndex = msg.prevLogIndex + len(msg.entries)
+            machine.commitIndex = max(machine.commitIndex, min(msg.leaderCommit, lastIndex))
+            machine.apply_committed()
+            if machine.lastApplied >= msg.leaderCommit:
+                machine.caughtUp = machine.control.clock()
+            machine.leaderRecent = True
             machine.control.reset_election_timer()
-            
+
+    @staticmethod
+    def handle_InstallSnapshot(machine, msg):
+        if msg.term == machine.term:
+            machine.leaderId = msg.source
+        if msg.term < machine.term:
+            machine.control.send_message(
+                InstallSnapshotResponse(
+                    dest=msg.source,
+                    term=machine.term,
+                    lastIncludedIndex=msg.lastIncludedIndex,
+                    offset=0,
+                    done=False
+                    )
+                )
+            return
+
+        # Chunks must arrive in order.  Anything else is ignored and the
+        # response tells the leader where to resume.
+        if msg.offset == 0:
+            machine.snapshotReceive = (msg.lastIncludedIndex, bytearray())
+        index, data = machine.snapshotReceive or (None, bytearray())
+        done = False
+        if index == msg.lastIncludedIndex and msg.offset == len(data):
+            data += msg.data
+            if msg.done:
+                machine.snapshotReceive = None
+                machine.install_snapshot(msg.lastIncludedIndex,
+                                         msg.lastIncludedTerm,
+                                         bytes(data))
+                done = True
+        machine.control.send_message(
+            InstallSnapshotResponse(
+                dest=msg.source,
+                term=machine.term,
+                lastIncludedIndex=msg.lastIncludedIndex,
+                offset=len(data),
+                done=done
+                )
+            )
+        machine.leaderRecent = True
+        machine.control.reset_election_timer()
 
 class Leader(RaftState):
     @staticmethod
     def handle_AppendEntriesResponse(machine, msg):
+        # Any response in our term means the follower still takes us as
+        # leader (as of the read round in the message)
+        machine.readQuorum.update(msg.source, msg.readSeq)
+        machine.check_reads()
+
+        # Responses may arrive out of date (for messages sent before the
+        # window was rolled back).  Those are ignored.
+
         # If the operation was successful, update leader settings for the follower
         if msg.success:
-            machine.matchIndex[msg.source] = msg.matchIndex
-            machine.nextIndex[msg.source] = msg.matchIndex+1
+            machine.probing[msg.source] = False
+            machine.matchIndex[msg.source] = max(machine.matchIndex[msg.source], msg.matchIndex)
+            machine.nextIndex[msg.source] = max(machine.nextIndex[msg.source], machine.matchIndex[msg.source]+1)
+            # Everything up to matchIndex has arrived (including messages
+            # whose response was lost)
+            inflight = machine.inflight[msg.source]
+            while inflight and inflight[0] <= machine.matchIndex[msg.source]:
+                inflight.popleft()
 
             # Check for consensus on log entries
-            matches = sorted(machine.matchIndex.values())
-            machine.commitIndex = matches[len(machine.matchIndex)//2]
-            if machine.lastApplied < machine.commitIndex:
-                machine.control.apply_entries(machine.log[machine.lastApplied+1:machine.commitIndex+1])
-                machine.lastApplied = machine.commitIndex
+            machine.quorum.update(msg.source, machine.matchIndex[msg.source])
+            machine.update_commit()
+
+            # Keep the pipeline full
+            machine.send_Pipelined(msg.source)
+
+        elif msg.rejectIndex <= machine.matchIndex[msg.source]:
+            pass       # Stale. That part of the log is known to match
+
+        elif not machine.probing[msg.source] or msg.rejectIndex == machine.nextIndex[msg.source] - 1:
+            # It failed for this follower.  Roll back any pipelined
+            # messages and go back to probing.  Immediately retry with a
+            # lower nextIndex value taken from the follower's hint
+            # (skipping a whole term of entries at a time).
+            machine.probing[msg.source] = True
+            machine.inflight[msg.source].clear()
+            machine.nextIndex[msg.source] = max(machine.matchIndex[msg.source] + 1,
+                                                min(machine.next_from_conflict(msg), msg.rejectIndex))
+            machine.send_AppendEntry(msg.source)
+
+    @staticmethod
+    def handle_InstallSnapshotResponse(machine, msg):
+        if msg.done:
+            # Follower now has everything up to the snapshot
+            machine.snapshotOffset[msg.source] = 0
+            machine.matchIndex[msg.source] = max(machine.matchIndex[msg.source], msg.lastIncludedIndex)
+            machine.quorum.update(msg.source, machine.matchIndex[msg.source])
+            machine.nextIndex[msg.source] = machine.matchIndex[msg.source] + 1
+            machine.probing[msg.source] = False
+            machine.inflight[msg.source].clear()
+            machine.send_AppendEntry(msg.source)
+        elif msg.lastIncludedIndex == machine.log.snapshotIndex:
+            # Send the next chunk
+            machine.snapshotOffset[msg.source] = msg.offset
+            machine.send_InstallSnapshot(msg.source)
         else:
-            # It failed for this follower.   Immediately retry with a
-            # lower nextIndex value
-            machine.nextIndex[msg.source] -= 1
+            # A newer snapshot has been taken since. Start over
+            machine.snapshotOffset[msg.source] = 0
             machine.send_AppendEntry(msg.source)
 
     @staticmethod
     def handle_LeaderTimeout(machine):
-        # Must send an append entries message to all followers
+        # Must send an append entries message to all followers.  Anything
+        # held for batching goes with it.  With lease reads, every
+        # heartbeat renews the lease.  Followers whose pipelined messages
+        # seem lost get them again.
+        machine.heldFrom = None
+        if machine.leaseReads:
+            machine.next_read_seq()
+        machine.check_inflight()
         machine.send_AppendEntries()
 
         # Must reset the leader timeout
@@ -250,10 +881,10 @@ class Candidate(RaftState):
             pass
 
         if msg.voteGranted:
-            machine.votesGranted += 1
-            if machine.votesGranted > (machine.control.nservers // 2):
+            if machine.votes.update(msg.source, 0) == 0:
                 print(f'Machine {machine.control.addr} became leader')
                 machine.state = Leader
+                machine.leaderId = machine.control.addr
                 machine.reset_leader()
                 # Upon leadership change, send an empty AppendEntries
                 machine.send_AppendEntries()
@@ -271,4 +902,8 @@ class Candidate(RaftState):
             machine.state = Follower
             machine.handle_AppendEntries(msg)
 
-
+    @staticmethod
+    def handle_InstallSnapshot(machine, msg):
+        if msg.term == machine.term:
+            machine.state = Follower
+            machine.handle_InstallSnapshot(msg)
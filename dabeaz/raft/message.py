@@ -10,13 +10,21 @@
 #   2. All message arguments are keyword arguments (better readability)
 #
 #   3. All messages include source, dest, and term.
+#
+#   4. Messages use __slots__.  Lots of them get created.
 
 class RaftMessage:
-    pass
+    __slots__ = ()
 
-# This is the "Arguments" (from pg. 4 table)
+# This is the "Arguments" (from pg. 4 table).  readSeq numbers the
+# leader's read (ReadIndex) rounds.  The follower echoes it back so the
+# leader knows that it was still leader when the round started.
 class AppendEntries(RaftMessage):
-    def __init__(self, *, dest, term, prevLogIndex, prevLogTerm, entries, leaderCommit, source=None):
+    __slots__ = ('source', 'dest', 'term', 'prevLogIndex', 'prevLogTerm', 'entries', 'leaderCommit',
+                 'readSeq')
+
+    def __init__(self, *, dest, term, prevLogIndex, prevLogTerm, entries, leaderCommit, readSeq=0,
+                 source=None):
         self.source = source
         self.dest = dest
         self.term = term
@@ -24,23 +32,39 @@ class AppendEntries(RaftMessage):
         self.prevLogTerm = prevLogTerm
         self.entries = entries
         self.leaderCommit = leaderCommit
+        self.readSeq = readSeq
 
     def __repr__(self):
-        return f'AppendEntries(dest={self.dest}, term={self.term}, prevLogIndex={self.prevLogIndex}, prevLogTerm={self.prevLogTerm}, leaderCommit={self.leaderCommit}, entries={self.entries})'
+        return f'AppendEntries(dest={self.dest}, term={self.term}, prevLogIndex={self.prevLogIndex}, prevLogTerm={self.prevLogTerm}, leaderCommit={self.leaderCommit}, readSeq={self.readSeq}, entries={self.entries})'
 
-# This is the "Results" (from pg. 4 table)
+# This is the "Results" (from pg. 4 table).  On failure, rejectIndex is
+# the prevLogIndex of the AppendEntries that was rejected (the leader
+# pipelines messages and needs to know which one failed).  conflictTerm
+# and conflictIndex tell the leader how far to back up (from pg. 7-8):
+# the term of the follower's entry at rejectIndex and the first index
+# with that term, or -1 and the follower's log length if it's too short.
 class AppendEntriesResponse(RaftMessage):
-    def __init__(self, *, dest, term, success, matchIndex, source=None):
+    __slots__ = ('source', 'dest', 'term', 'success', 'matchIndex', 'rejectIndex',
+                 'conflictTerm', 'conflictIndex', 'readSeq')
+
+    def __init__(self, *, dest, term, success, matchIndex, rejectIndex=-1,
+                 conflictTerm=-1, conflictIndex=-1, readSeq=0, source=None):
         self.source = source
         self.dest = dest
         self.term = term
         self.success = success
         self.matchIndex = matchIndex
+        self.rejectIndex = rejectIndex
+        self.conflictTerm = conflictTerm
+        self.conflictIndex = conflictIndex
+        self.readSeq = readSeq
         
     def __repr__(self):
-        return f'AppendEntriesResponse(dest={self.dest}, term={self.term}, success={self.success}, matchIndex={self.matchIndex})'
+        return f'AppendEntriesResponse(dest={self.dest}, term={self.term}, success={self.success}, matchIndex={self.matchIndex}, rejectIndex={self.rejectIndex}, conflictTerm={self.conflictTerm}, conflictIndex={self.conflictIndex}, readSeq={self.readSeq})'
 
 class RequestVote(RaftMessage):
+    __slots__ = ('source', 'dest', 'term', 'lastLogIndex', 'lastLogTerm')
+
     def __init__(self, *, dest, term, lastLogIndex, lastLogTerm, source=None):
         self.source = source
         self.dest = dest
@@ -52,6 +76,8 @@ class RequestVote(RaftMessage):
         return f'RequestVote(dest={self.dest}, term={self.term}, lastLogIndex={self.lastLogIndex}, lastLogTerm={self.lastLogTerm})'
 
 class RequestVoteResponse(RaftMessage):
+    __slots__ = ('source', 'dest', 'term', 'voteGranted')
+
     def __init__(self, *, dest, term, voteGranted, source=None):
         self.source = source
         self.dest = dest
@@ -60,3 +86,38 @@ class RequestVoteResponse(RaftMessage):
 
     def __repr__(self):
         return f'RequestVoteResponse(dest={self.dest}, term={self.term}, voteGranted={self.voteGranted})'
+
+# Sent by the leader to bring a follower up to date when the log entries
+# it needs have been discarded by compaction (from pg. 13).  Large
+# snapshots are sent in chunks starting at byte offset.
+class InstallSnapshot(RaftMessage):
+    __slots__ = ('source', 'dest', 'term', 'lastIncludedIndex', 'lastIncludedTerm', 'offset', 'data', 'done')
+
+    def __init__(self, *, dest, term, lastIncludedIndex, lastIncludedTerm, offset, data, done, source=None):
+        self.source = source
+        self.dest = dest
+        self.term = term
+        self.lastIncludedIndex = lastIncludedIndex
+        self.lastIncludedTerm = lastIncludedTerm
+        self.offset = offset
+        self.data = data
+        self.done = done
+
+    def __repr__(self):
+        return f'InstallSnapshot(dest={self.dest}, term={self.term}, lastIncludedIndex={self.lastIncludedIndex}, lastIncludedTerm={self.lastIncludedTerm}, offset={self.offset}, size={len(self.data)}, done={self.done})'
+
+# offset is the number of snapshot bytes the follower has received so far.
+# done is set once the snapshot has been installed.
+class InstallSnapshotResponse(RaftMessage):
+    __slots__ = ('source', 'dest', 'term', 'lastIncludedIndex', 'offset', 'done')
+
+    def __init__(self, *, dest, term, lastIncludedIndex, offset, done, source=None):
+        self.source = source
+        self.dest = dest
+        self.term = term
+        self.lastIncludedIndex = lastIncludedIndex
+        self.offset = offset
+        self.done = done
+
+    def __repr__(self):
+        return f'InstallSnapshotResponse(dest={self.dest}, term={self.term}, lastIncludedIndex={self.lastIncludedIndex}, offset={self.offset}, done={self.done})'
@@ -0,0 +1,63 @@
+# quorum.py
+#
+# Incremental tracking of the highest log index stored on a quorum.
+#
+# The leader used to sort all of the matchIndex values on every response
+# to find the median.  Instead, QuorumTracker keeps the current quorum
+# index along with the total weight of servers whose match is beyond it.
+# Match indices only go up, so the quorum index only goes up.  Each time
+# it moves, it moves to the next distinct match value (kept in a heap).
+# The cost per update is O(log n) for n servers regardless of how many
+# log entries are involved.
+#
+# Servers can be given weights.  By default every server has weight 1
+# and a quorum is a majority of the total weight.  It can be made bigger,
+# but never half or less (two quorums with no server in common could
+# then each elect a leader or commit entries).
+
+import heapq
+
+class QuorumTracker:
+    def __init__(self, servers, weights=None, quorum=None):
+        weights = weights or { }
+        self.weights = { server: weights.get(server, 1) for server in servers }
+        total = sum(self.weights.values())
+        self.quorum = quorum if quorum is not None else total // 2 + 1
+        # Any two quorums must have a server in common
+        assert total < 2 * self.quorum <= 2 * total, 'Quorum must be more than half the total weight'
+        self.match = { server: -1 for server in servers }
+        self.index = -1                      # Highest index on a quorum
+        self._weight_at = { -1: total }      # match index -> total weight
+        self._above = 0                      # Weight of servers with match > index
+        self._pending = [ ]                  # Heap of match values > index
+
+    def update(self, server, index):
+        # Record that server has the log up to index.  Returns the quorum index
+        old = self.match[server]
+        if index <= old:
+            return self.index
+        self.match[server] = index
+        weight = self.weights[server]
+        self._weight_at[old] -= weight
+        if not self._weight_at[old]:
+            del self._weight_at[old]
+        if index not in self._weight_at:
+            self._weight_at[index] = 0
+            if index > self.index:
+                heapq.heappush(self._pending, index)
+                if len(self._pending) > 2 * len(self._weight_at):
+                    # Drop values no server has anymore
+                    self._pending = [ v for v in self._weight_at if v > self.index ]
+                    heapq.heapify(self._pending)
+        self._weight_at[index] += weight
+        if old <= self.index < index:
+            self._above += weight
+
+        # Everything above self.index has at least the smallest pending
+        # match value.  If that's a quorum, the quorum index moves up to it.
+        while self._pending and self._above >= self.quorum:
+            nxt = heapq.heappop(self._pending)
+            if nxt > self.index and nxt in self._weight_at:
+                self.index = nxt
+                self._above -= self._weight_at[nxt]
+        return self.index
@@ -2,19 +2,32 @@
 
 from .dispatcher import ChannelDispatcher
 from .control import RaftController
+from .storage import make_storage
 from .machine import RaftMachine
+from .config import RAFT_RUNTIME
 
-def main(addr):
-    dispatch = ChannelDispatcher(addr)
+def make_controller(addr, machine, runtime=RAFT_RUNTIME):
+    # Controller and dispatcher for the chosen runtime ('thread' or 'asyncio')
+    if runtime == 'asyncio':
+        from .aiocontrol import AsyncRaftController, start_loop
+        from .aiodispatcher import AsyncChannelDispatcher
+        loop = start_loop()
+        dispatch = AsyncChannelDispatcher(addr, loop)
+        controller = AsyncRaftController(addr, dispatch, machine, loop)
+    else:
+        dispatch = ChannelDispatcher(addr)
+        controller = RaftController(addr, dispatch, machine)
     dispatch.start()
-    controller = RaftController(addr, dispatch, RaftMachine())
+    return controller
+
+def main(addr, runtime=RAFT_RUNTIME):
+    controller = make_controller(addr, RaftMachine(storage=make_storage(addr)), runtime)
     controller.start()
     return controller
 
 if __name__ == '__main__':
     import sys
     import time
-    main(int(sys.argv[1]))
+    main(int(sys.argv[1]), *sys.argv[2:3])
     while True:
         time.sleep(1)
-
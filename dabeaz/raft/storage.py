@@ -0,0 +1,200 @@
+# storage.py
+#
+# Persistent storage for the Raft log and the term/votedFor metadata.
+#
+# The machine keeps its working copy of the log in memory.  Every change
+# is also handed to a storage object so that it can be recovered after
+# a restart.  When the log is compacted, the snapshot that replaces the
+# log prefix is saved as well.  Two implementations:
+#
+#   MemoryStorage   - Keeps nothing.  The original in-memory behavior.
+#   FileStorage     - Append-only file of records.
+#
+# Durability modes for FileStorage:
+#
+#   'always'   - fsync after every record.  Safest.  Slowest.
+#   'group'    - Records are written, but only fsync'd when sync() is
+#                called.  The controller calls sync() once for every
+#                batch of events it processes (and holds outgoing messages
+#                until it returns).  Everything arriving within the
+#                batch window shares one fsync.
+#   'interval' - A background thread fsyncs every `interval` seconds.
+#                A crash may lose the most recent writes.
+
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from .config import *
+
+class MemoryStorage:
+    # Seconds the controller should spend collecting a batch of events
+    # before calling sync().  0 means "whatever is already queued".
+    commit_window = 0
+
+    def load(self):
+        # Returns (term, votedFor, snapshot, entries).  snapshot is
+        # (index, term, data) or None.  entries follow the snapshot.
+        return 0, None, None, []
+
+    def save_state(self, term, votedFor):
+        pass
+
+    def append(self, index, entries):
+        # Replace the log starting at index with entries
+        pass
+
+    def save_snapshot(self, index, term, data, entries):
+        # Snapshot covering the log up to index.  entries are the
+        # remaining log entries (index+1 onward)
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+# Each record is a pickled tuple preceded by an 8-byte header containing
+# the payload size and a CRC32.  A torn write at the end of the file
+# (crash in the middle of a record) is detected and discarded on load.
+#
+# The snapshot lives in a separate file (path + '.snap').  Taking a
+# snapshot writes that file, then rewrites the log file with only the
+# entries that follow it.  Both are replaced atomically by rename.
+_header = struct.Struct('>II')
+
+class FileStorage(MemoryStorage):
+    def __init__(self, path, sync_mode='always', commit_window=0.002, interval=1.0):
+        assert sync_mode in {'always', 'group', 'interval'}, sync_mode
+        self.path = path
+        self.sync_mode = sync_mode
+        self.commit_window = commit_window if sync_mode == 'group' else 0
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._file = None
+        self._term = 0
+        self._votedFor = None
+        self._first = 0          # Log index of _entries[0]
+        self._entries = []
+        self._load_file()
+        self._file = open(path, 'ab')
+        if sync_mode == 'interval':
+            threading.Thread(target=self._run_interval_sync, daemon=True).start()
+
+    def _load_file(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + _header.size <= len(data):
+            size, crc = _header.unpack_from(data, pos)
+            payload = data[pos+_header.size:pos+_header.size+size]
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                break
+            self._replay(pickle.loads(payload))
+            pos += _header.size + size
+        if pos < len(data):
+            # Discard a partially written record at the end
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+
+    def _replay(self, record):
+        kind, *args = record
+        if kind == 'state':
+            self._term, self._votedFor = args
+        elif kind == 'first':
+            self._first, = args
+            self._entries = []
+        elif kind == 'append':
+            index, entries = args
+            self._entries[index-self._first:] = entries
+
+    def load(self):
+        snapshot = None
+        if os.path.exists(self.path + '.snap'):
+            with open(self.path + '.snap', 'rb') as f:
+                snapshot = pickle.load(f)
+        entries, self._entries = self._entries, []
+        if snapshot:
+            # A crash between writing the snapshot and rewriting the log
+            # leaves entries already covered by the snapshot
+            entries = entries[max(0, snapshot[0] + 1 - self._first):]
+        return self._term, self._votedFor, snapshot, entries
+
+    def _write(self, record):
+        payload = pickle.dumps(record)
+        with self._lock:
+            self._file.write(_header.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self._dirty = True
+            if self.sync_mode == 'always':
+                self._fsync()
+
+    def _fsync(self):
+        # Must hold the lock
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+    def save_state(self, term, votedFor):
+        self._term = term
+        self._votedFor = votedFor
+        self._write(('state', term, votedFor))
+
+    def append(self, index, entries):
+        self._write(('append', index, entries))
+
+    def save_snapshot(self, index, term, data, entries):
+        _write_atomic(self.path + '.snap', pickle.dumps((index, term, data)))
+        records = [('state', self._term, self._votedFor),
+                   ('first', index + 1),
+                   ('append', index + 1, entries)]
+        contents = bytearray()
+        for record in records:
+            payload = pickle.dumps(record)
+            contents += _header.pack(len(payload), zlib.crc32(payload))
+            contents += payload
+        with self._lock:
+            self._file.close()
+            _write_atomic(self.path, contents)
+            self._file = open(self.path, 'ab')
+            self._dirty = False
+
+    def sync(self):
+        if self.sync_mode == 'group':
+            with self._lock:
+                if self._dirty:
+                    self._fsync()
+
+    def _run_interval_sync(self):
+        while self._file:
+            time.sleep(self.interval)
+            with self._lock:
+                if self._file and self._dirty:
+                    self._fsync()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._fsync()
+                self._file.close()
+                self._file = None
+
+def _write_atomic(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def make_storage(addr):
+    # Storage for a server as set up in config.py
+    return FileStorage(f'raftlog-{addr}.dat', LOG_SYNC_MODE,
+                       commit_window=GROUP_COMMIT_WINDOW,
+                       interval=LOG_SYNC_INTERVAL)
@@ -1,9 +1,32 @@
 from .machine import RaftMachine, Follower, Candidate, Leader, LogEntry
-from .control import MockRaftController
+from .control import MockRaftController, RaftController
+from .dispatcher import QueueDispatcher
 from .message import RequestVote, RequestVoteResponse, AppendEntries, AppendEntriesResponse
+from .message import InstallSnapshot, InstallSnapshotResponse
+from .storage import FileStorage, MemoryStorage
+from .quorum import QuorumTracker
+from .timers import TimerService
+from . import debuglog
+from .aiocontrol import AsyncRaftController
+from .aiodispatcher import AsyncQueueDispatcher
+from .channel import Channel
+from . import codec
+import asyncio
+import collections
+import pickle
+import threading
+import time
 
 NSERVERS = 5
 
+# A KVServer with a stand-in for its controller.  Attributes the test
+# needs go in machine (a dict) and the keyword arguments (controller)
+def make_kv_server(machine=(), **control):
+    from .kvserver import KVServer
+    from types import SimpleNamespace
+    return KVServer(SimpleNamespace(machine=SimpleNamespace(snapshot=None, **dict(machine)),
+                                    debug_log=debuglog.DebugLog('unused', 'off'), **control))
+
 def test_initial():
     control = MockRaftController(0, NSERVERS)
     machine = RaftMachine(control)
@@ -37,7 +60,7 @@ def test_election_successful():
             )
 
     assert machine.state == Leader
-    assert machine.votedFor is None
+    assert machine.votedFor == 0
     assert machine.nextIndex == {peer:0 for peer in control.peers }
     assert machine.matchIndex == {peer:-1 for peer in control.peers }
 
@@ -144,6 +167,30 @@ def test_request_vote_fail_already_voted():
     assert control.messages[0].term == 2
     return machine, control
 
+def test_request_vote_log_not_up_to_date():
+    # Votes go only to candidates whose log is at least as up to date:
+    # a later last term, or the same last term and at least as long
+    machine, control = test_initial()
+    machine.term = 2
+    machine.log.extend([ LogEntry(1, 'a'), LogEntry(1, 'b'), LogEntry(2, 'c') ])
+    for term, lastLogIndex, lastLogTerm, granted in [ (3, 5, 1, False),     # Older
+                                                      (4, 1, 2, False),     # Shorter
+                                                      (5, -1, -1, False),   # Empty
+                                                      (6, 2, 2, True),
+                                                      (7, 0, 3, True) ]:
+        machine.handle_Message(
+            RequestVote(source=1, dest=0, term=term, lastLogIndex=lastLogIndex, lastLogTerm=lastLogTerm)
+            )
+        assert control.messages[-1].voteGranted == granted
+        assert machine.votedFor == (1 if granted else None)
+
+    # The last entry may be covered by the snapshot
+    machine.log.compact(2)
+    machine.handle_Message(RequestVote(source=3, dest=0, term=8, lastLogIndex=1, lastLogTerm=2))
+    assert not control.messages[-1].voteGranted
+    machine.handle_Message(RequestVote(source=3, dest=0, term=9, lastLogIndex=2, lastLogTerm=2))
+    assert control.messages[-1].voteGranted
+
 def test_follower_downgrade():
     # Tests to see if a message with higher term causes downgrade in state
     # to Follower
@@ -272,7 +319,1014 @@ def test_append_entries_response():
     assert machine.matchIndex[2] == 2
     assert machine.nextIndex[2] == 3
 
+def test_storage_recovery(tmp_path):
+    # Log, term, and vote survive a restart
+    path = str(tmp_path / 'raftlog.dat')
+    machine = RaftMachine(MockRaftController(0, NSERVERS), FileStorage(path))
+    machine.handle_Message(
+        AppendEntries(source=1,
+                      dest=0,
+                      term=1,
+                      prevLogIndex=-1,
+                      prevLogTerm=-1,
+                      leaderCommit=-1,
+                      entries=[ LogEntry(1, 'x'), LogEntry(1, 'y') ]
+                      )
+        )
+    machine.handle_Message(
+        RequestVote(source=2,
+                    dest=0,
+                    term=2,
+                    lastLogIndex=1,
+                    lastLogTerm=1,
+                    )
+        )
+    # Conflicting entry replaces the end of the log
+    machine.handle_Message(
+        AppendEntries(source=2,
+                      dest=0,
+                      term=2,
+                      prevLogIndex=0,
+                      prevLogTerm=1,
+                      leaderCommit=-1,
+                      entries=[ LogEntry(2, 'z') ]
+                      )
+        )
+    machine.storage.close()
 
-       
+    machine = RaftMachine(MockRaftController(0, NSERVERS), FileStorage(path))
+    assert machine.term == 2
+    assert machine.votedFor == 2
+    assert machine.log[:] == [ LogEntry(1, 'x'), LogEntry(2, 'z') ]
+    machine.storage.close()
+
+def test_storage_torn_record(tmp_path):
+    # A partially written record at the end of the file is discarded
+    path = str(tmp_path / 'raftlog.dat')
+    storage = FileStorage(path, 'group')
+    storage.append(0, [ LogEntry(1, 'x') ])
+    storage.save_state(1, None)
+    storage.sync()
+    storage.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x00\x00\x01\x00garbage')
+
+    term, votedFor, snapshot, entries = FileStorage(path).load()
+    assert (term, votedFor, snapshot, entries) == (1, None, None, [ LogEntry(1, 'x') ])
+
+def test_storage_group_commit(tmp_path, monkeypatch):
+    # Events queued together are handled as one batch with one sync(),
+    # and nothing is sent before it
+    class CountingStorage(MemoryStorage):
+        syncs = [ ]
+        def sync(self):
+            self.syncs.append(dispatch.channels[1].qsize())
+            controller.running = False      # Stop after one batch
+    monkeypatch.chdir(tmp_path)
+    dispatch = QueueDispatcher(3)
+    controller = RaftController(0, dispatch, RaftMachine(storage=CountingStorage()))
+    for n in range(5):
+        controller.post(('handle_Message',
+                         AppendEntries(source=1, dest=0, term=1, prevLogIndex=n-1, prevLogTerm=1 if n else -1,
+                                       entries=[ LogEntry(1, n) ], leaderCommit=-1)))
+    controller.running = True
+    controller.run()
+    assert CountingStorage.syncs == [ 0 ]
+    assert len(controller.machine.log) == 5
+    assert dispatch.channels[1].qsize() == 5
+
+def test_snapshot_compaction():
+    machine, control = test_election_successful()
+    machine.snapshotThreshold = 2
+    machine.snapshotChunkSize = 4
+    for item in ['x', 'y', 'z']:
+        machine.append_new_entry(item)
+    for peer in [1, 2]:
+        machine.handle_Message(
+            AppendEntriesResponse(source=peer,
+                                  dest=0,
+                                  term=1,
+                                  success=True,
+                                  matchIndex=2)
+            )
+    # Everything applied was snapshotted and removed from the log
+    assert machine.lastApplied == 2
+    assert machine.log.snapshotIndex == 2
+    assert machine.log.entries == []
+    assert len(machine.log) == 3
+    assert control.applied == ['x', 'y', 'z']
+    return machine, control
+
+def test_install_snapshot():
+    leader, lcontrol = test_snapshot_compaction()
+    fcontrol = MockRaftController(3, NSERVERS)
+    follower = RaftMachine(fcontrol)
+
+    # Follower 3 has nothing.  It gets the snapshot in chunks
+    del lcontrol.messages[:]
+    leader.send_AppendEntry(3)
+    nchunks = 0
+    while lcontrol.messages:
+        msg = lcontrol.messages.pop(0)
+        if type(msg) is InstallSnapshot:
+            assert len(msg.data) <= 4
+            nchunks += 1
+        follower.handle_Message(msg)
+        leader.handle_Message(fcontrol.messages.pop(0))
+
+    assert nchunks == (len(leader.snapshot) + 3) // 4
+    assert fcontrol.applied == ['x', 'y', 'z']
+    assert follower.log.snapshotIndex == 2
+    assert follower.lastApplied == 2
+    assert leader.matchIndex[3] == 2
+    assert leader.nextIndex[3] == 3
+
+def test_storage_snapshot(tmp_path):
+    path = str(tmp_path / 'raftlog.dat')
+    machine = RaftMachine(MockRaftController(0, NSERVERS), FileStorage(path))
+    machine.log.extend([ LogEntry(1, 'x'), LogEntry(1, 'y'), LogEntry(1, 'z') ])
+    machine.storage.append(0, machine.log[:])
+    machine.commitIndex = 1
+    machine.apply_committed()
+    machine.take_snapshot()
+    machine.storage.close()
+
+    machine = RaftMachine(MockRaftController(0, NSERVERS), FileStorage(path))
+    assert machine.lastApplied == 1
+    assert machine.log.snapshotIndex == 1
+    assert machine.log[:] == [ LogEntry(1, 'z') ]
+    assert machine.snapshot is not None
+
+def test_codec_roundtrip():
+    msgs = [
+        AppendEntries(source=0, dest=1, term=2, prevLogIndex=5, prevLogTerm=1, leaderCommit=4,
+                      entries=[ LogEntry(1, ('x', 1)), LogEntry(2, {'a': [None, True, 2.5, b'z']}) ]),
+        AppendEntriesResponse(source=1, dest=0, term=2, success=False, matchIndex=-1),
+        RequestVote(source=2, dest=3, term=7, lastLogIndex=-1, lastLogTerm=-1),
+        RequestVoteResponse(source=3, dest=2, term=7, voteGranted=True),
+        InstallSnapshot(source=0, dest=4, term=2, lastIncludedIndex=9, lastIncludedTerm=1,
+                        offset=100, data=b'chunk', done=True),
+        InstallSnapshotResponse(source=4, dest=0, term=2, lastIncludedIndex=9, offset=105, done=True),
+    ]
+    for msg in msgs:
+        decoded = codec.decode(codec.encode(msg))
+        assert type(decoded) is type(msg)
+        assert all(getattr(decoded, name) == getattr(msg, name) for name in type(msg).__slots__)
 
-                      
+def test_codec_bad_data():
+    data = codec.encode(RequestVote(source=2, dest=3, term=7, lastLogIndex=-1, lastLogTerm=-1))
+    for bad in [ data[:-1], data + b'\x00', b'\xff' + data[1:], data[:1] + b'\x63' + data[2:] ]:
+        try:
+            codec.decode(bad)
+            assert False, 'Expected CodecError'
+        except codec.CodecError:
+            pass
+
+    data = codec.encode(AppendEntries(source=0, dest=1, term=2, prevLogIndex=5, prevLogTerm=1,
+                                      leaderCommit=4, entries=[ LogEntry(1, 'x') ]))
+    for bad in [ data[:-1], data + b'\x00' ]:
+        try:
+            codec.decode(bad)
+            assert False, 'Expected CodecError'
+        except codec.CodecError:
+            pass
+
+def test_codec_lazy_entries():
+    msg = AppendEntries(source=0, dest=1, term=2, prevLogIndex=5, prevLogTerm=1, leaderCommit=4,
+                        entries=[ LogEntry(1, ('x', 1)), LogEntry(2, 'y') ])
+    data = codec.encode(msg)
+    # Payloads aren't decoded until the entry is used.  Buffers other than bytes work too
+    for buf in [ data, bytearray(data), memoryview(data) ]:
+        entries = codec.decode(buf).entries
+        assert all(e._entry is LogEntry.UNDECODED and type(e._payload) is bytes for e in entries)
+        assert [ e.term for e in entries ] == [1, 2]
+        assert [ e.entry for e in entries ] == [('x', 1), 'y']
+
+    # Undecoded entries are stored (pickled) as the payload
+    entry = codec.decode(data).entries[0]
+    copy = pickle.loads(pickle.dumps(entry))
+    assert copy._entry is LogEntry.UNDECODED and copy == entry
+
+    # A payload that doesn't decode fails when the entry is used
+    entry = LogEntry(1, LogEntry.UNDECODED, b'\xff')
+    try:
+        entry.entry
+        assert False, 'Expected CodecError'
+    except codec.CodecError:
+        pass
+
+def test_codec_unencodable_entry(tmp_path, monkeypatch):
+    # Items the codec can't send are refused before they reach the log
+    machine, control = test_election_successful()
+    try:
+        machine.append_new_entry(('k', {1, 2}))
+        assert False, 'Expected TypeError'
+    except TypeError:
+        pass
+    assert len(machine.log) == 0
+
+    monkeypatch.chdir(tmp_path)
+    controller = RaftController(0, QueueDispatcher(3), machine)
+    fut = controller.append_entry(('k', {1, 2}))
+    controller.handle_event(controller.event_queue.get())
+    assert isinstance(fut.exception(), TypeError)
+    assert not controller._pending
+
+def test_pipelined_append_entries():
+    machine, control = test_election_successful()
+    machine.maxInflight = 2
+    # Follower 1 matches the (empty) log.  Probing is over.
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=-1)
+        )
+    assert not machine.probing[1]
+
+    # New entries go out without waiting for responses, up to the window
+    del control.messages[:]
+    for item in ['a', 'b', 'c']:
+        machine.append_new_entry(item)
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (-1, 1), (0, 1) ]
+    assert machine.nextIndex[1] == 2
+
+    # Window is full.  Heartbeats go out at the last known match
+    del control.messages[:]
+    machine.handle_LeaderTimeout()
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (-1, 0) ]
+
+    # A response opens the window
+    del control.messages[:]
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=0)
+        )
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (1, 1) ]
+    assert machine.nextIndex[1] == 3
+
+    # A failure rolls the window back to the last match and probes
+    del control.messages[:]
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=False, matchIndex=-1, rejectIndex=1)
+        )
+    assert machine.probing[1]
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (0, 2) ]
+
+    # Failure of another message sent before the rollback is ignored
+    del control.messages[:]
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=False, matchIndex=-1, rejectIndex=2)
+        )
+    assert machine.nextIndex[1] == 1
+    assert not control.messages
+
+def test_pipelined_window_lost():
+    # Follower 1 is down while a full window goes out.  Once it's back,
+    # the heartbeats succeed (they're sent at the last match), so the
+    # lost window has to be noticed and resent
+    machine, control = test_election_successful()
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=-1)
+        )
+    follower = RaftMachine(MockRaftController(1, NSERVERS))
+    follower.term = 1
+    machine.maxAppendEntries = 1
+    for n in range(10):
+        machine.append_new_entry(n)
+    assert list(machine.inflight[1]) == [ 0, 1, 2, 3 ]
+    for _ in range(3):
+        del control.messages[:]
+        machine.handle_LeaderTimeout()
+        # Deliver everything to follower 1 and the responses back
+        while control.messages:
+            msgs = [ m for m in control.messages if m.dest == 1 ]
+            del control.messages[:]
+            for msg in msgs:
+                msg.source = 0
+                follower.handle_Message(msg)
+            for resp in follower.control.messages:
+                machine.handle_Message(resp)
+            del follower.control.messages[:]
+    assert len(follower.log) == 10
+    assert machine.matchIndex[1] == 9
+    assert not machine.inflight[1]
+
+def test_pipelined_window_lost_under_load():
+    # As above, but new entries keep arriving.  They mustn't put off the
+    # leader timeout, or the follower gets nothing (its window is full)
+    machine, control = test_election_successful()
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=-1)
+        )
+    follower = RaftMachine(MockRaftController(1, NSERVERS))
+    follower.term = 1
+    machine.maxAppendEntries = 1
+    for n in range(4):
+        machine.append_new_entry(n)     # Lost
+    for tick in range(4):
+        control.leader_timeout_reset = False
+        del control.messages[:]
+        for n in range(5):
+            machine.append_new_entry(n)
+        assert not control.leader_timeout_reset
+        machine.handle_LeaderTimeout()
+        while control.messages:
+            msgs = [ m for m in control.messages if m.dest == 1 ]
+            del control.messages[:]
+            for msg in msgs:
+                msg.source = 0
+                follower.handle_Message(msg)
+            for resp in follower.control.messages:
+                machine.handle_Message(resp)
+            del follower.control.messages[:]
+    assert len(follower.log) == len(machine.log) == 24
+    assert machine.matchIndex[1] == 23
+
+def test_batched_new_entries():
+    machine, control = test_election_successful()
+    machine.batchDelay = 0.001
+    machine.batchEntries = 4
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=-1)
+        )
+
+    # New entries are held until the flush
+    del control.messages[:]
+    for item in ['a', 'b', 'c']:
+        machine.append_new_entry(item)
+    assert not control.messages
+    assert control.flush_delay == 0.001
+    machine.flush_NewEntries()
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (-1, 3) ]
+
+    # A full batch goes out without waiting
+    del control.messages[:]
+    for item in ['d', 'e', 'f', 'g']:
+        machine.append_new_entry(item)
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (2, 4) ]
+
+def test_read_index():
+    machine, control = test_election_successful()
+    # No entry from this term yet.  A no-op is added and a round of
+    # heartbeats goes out.  A second read waits for the next round.
+    del control.messages[:]
+    machine.read_index('r1')
+    machine.read_index('r2')
+    assert machine.log[0].entry is None
+    assert { m.readSeq for m in control.messages } == { 1 }
+    for peer in [1, 2]:
+        machine.handle_Message(
+            AppendEntriesResponse(source=peer, dest=0, term=1, success=True, matchIndex=0, readSeq=1)
+            )
+    # Round 1 confirmed and the no-op applied.  Round 2 started
+    assert control.reads == [ ('r1', 0) ]
+    assert machine.readRound[0] == 2
+
+    # Reads in progress fail if leadership is lost
+    machine.handle_Message(
+        AppendEntries(source=1, dest=0, term=2, prevLogIndex=0, prevLogTerm=1, entries=[], leaderCommit=0)
+        )
+    assert control.reads == [ ('r1', 0), ('r2', None) ]
+
+def test_read_lease():
+    machine, control = test_election_successful()
+    machine.leaseReads = True
+    machine.append_new_entry('x')
+    control.time = 10.0
+    machine.handle_LeaderTimeout()
+    assert not machine.has_lease()
+    for peer in [1, 2]:
+        machine.handle_Message(
+            AppendEntriesResponse(source=peer, dest=0, term=1, success=True, matchIndex=0,
+                                  readSeq=machine.readSeq)
+            )
+    # Lease runs from when the heartbeat went out
+    assert machine.has_lease()
+    control.time = 10.0 + machine.leaseTime
+    assert not machine.has_lease()
+
+    # A follower that's hearing from a leader ignores votes
+    follower, fcontrol = test_append_entries_initial()
+    follower.leaseReads = True
+    follower.handle_Message(
+        AppendEntries(source=1, dest=0, term=1, prevLogIndex=0, prevLogTerm=1, entries=[], leaderCommit=0)
+        )
+    follower.handle_Message(
+        RequestVote(source=2, dest=0, term=2, lastLogIndex=0, lastLogTerm=1)
+        )
+    assert follower.term == 1
+    follower.handle_ElectionTimeout()
+    assert follower.state == Candidate
+
+def test_follower_reads(tmp_path, monkeypatch):
+    follower, control = test_append_entries_initial()
+    control.time = 5.0
+    follower.handle_Message(
+        AppendEntries(source=1, dest=0, term=1, prevLogIndex=0, prevLogTerm=1, entries=[], leaderCommit=0)
+        )
+    control.time = 7.0
+    assert follower.staleness() == 2.0
+
+    # Waiters complete once the applied state catches up
+    monkeypatch.chdir(tmp_path)
+    controller = RaftController(0, QueueDispatcher(3), RaftMachine())
+    fut = controller.wait_applied(1)
+    controller.handle_event(controller.event_queue.get())
+    controller.check_waiters()
+    assert not fut.done()
+    controller.machine.lastApplied = 1
+    controller.check_waiters()
+    assert fut.result() == 1
+
+def test_leader_id():
+    machine, control = test_append_entries_initial()
+    assert machine.leaderId == 1
+    machine.handle_ElectionTimeout()
+    assert machine.leaderId is None
+    leader, lcontrol = test_election_successful()
+    assert leader.leaderId == 0
+
+def test_append_entries_duplicate():
+    # A stale AppendEntries must not truncate entries that follow it
+    machine, control = test_append_entries_initial()
+    machine.append_entries(0, 1, [ LogEntry(1, 'y'), LogEntry(1, 'z') ])
+    machine.append_entries(-1, -1, [ LogEntry(1, 'x') ])
+    assert machine.log[:] == [ LogEntry(1, 'x'), LogEntry(1, 'y'), LogEntry(1, 'z') ]
+
+def test_conflict_hint_round_trips():
+    # After a long partition, the follower has many entries from terms the
+    # leader never saw.  Measure the round trips needed to repair it.
+    lcontrol = MockRaftController(0, NSERVERS)
+    leader = RaftMachine(lcontrol)
+    leader.log.extend([ LogEntry(1, n) for n in range(100) ] +
+                      [ LogEntry(4, n) for n in range(300) ])
+    leader.term = 5
+    leader.state = Leader
+    leader.reset_leader()
+
+    fcontrol = MockRaftController(1, NSERVERS)
+    follower = RaftMachine(fcontrol)
+    follower.term = 3
+    follower.log.extend([ LogEntry(1, n) for n in range(100) ] +
+                        [ LogEntry(2, n) for n in range(500) ] +
+                        [ LogEntry(3, n) for n in range(500) ])
+
+    leader.send_AppendEntry(1)
+    round_trips = 0
+    while lcontrol.messages:
+        round_trips += 1
+        follower.handle_Message(lcontrol.messages.pop(0))
+        leader.handle_Message(fcontrol.messages.pop(0))
+        if leader.matchIndex[1] == len(leader.log) - 1:
+            break
+
+    # One entry at a time would need 301 round trips.  With hints, the
+    # first rejection skips the follower's whole run of term 2 entries
+    assert round_trips == 2
+    assert follower.log[:] == leader.log[:]
+
+def test_stale_append_entries_compacted():
+    # An AppendEntries from an old term at an index covered by the
+    # snapshot is refused without looking at the (discarded) entries
+    control = MockRaftController(0, NSERVERS)
+    machine = RaftMachine(control)
+    machine.term = 2
+    machine.log.extend([ LogEntry(1, n) for n in range(5) ] + [ LogEntry(2, n) for n in range(10) ])
+    machine.commitIndex = machine.lastApplied = 12
+    machine.log.compact(9)
+    machine.handle_Message(
+        AppendEntries(source=1, dest=0, term=1, prevLogIndex=3, prevLogTerm=1, entries=[], leaderCommit=3)
+        )
+    resp = control.messages[-1]
+    assert (resp.success, resp.term, resp.conflictTerm, resp.conflictIndex) == (False, 2, -1, 15)
+
+def test_bounded_append_entries():
+    machine, control = test_election_successful()
+    machine.maxAppendEntries = 3
+    machine.maxAppendBytes = 40
+    machine.log.extend([ LogEntry(1, n) for n in range(8) ] + [ LogEntry(1, 'x'*100), LogEntry(1, 9) ])
+
+    # Probe covers at most maxAppendEntries entries
+    del control.messages[:]
+    machine.nextIndex[1] = 0
+    machine.send_AppendEntry(1)
+    assert [ len(m.entries) for m in control.messages ] == [ 3 ]
+
+    # Once matched, the rest goes out in bounded messages.  The byte limit
+    # ends the second message before the long string.  An entry over the
+    # limit still goes out in a message by itself
+    del control.messages[:]
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=2)
+        )
+    sizes = [ len(m.entries) for m in control.messages if m.dest == 1 ]
+    assert sizes == [ 3, 2, 1, 1 ]
+    assert machine.nextIndex[1] == 10
+
+def test_commit_current_term_only():
+    machine, control = test_election_successful()
+    # Entries left over from an earlier term
+    machine.log.extend([ LogEntry(0, 'x'), LogEntry(0, 'y') ])
+    for peer in [1, 2]:
+        machine.handle_Message(
+            AppendEntriesResponse(source=peer, dest=0, term=1, success=True, matchIndex=1)
+            )
+    assert machine.commitIndex == -1     # Replicated, but not from this term
+
+    machine.append_new_entry('z')
+    for peer in [1, 2]:
+        machine.handle_Message(
+            AppendEntriesResponse(source=peer, dest=0, term=1, success=True, matchIndex=2)
+            )
+    assert machine.commitIndex == 2
+    assert control.applied == ['x', 'y', 'z']
+
+def test_quorum_tracker_weights():
+    tracker = QuorumTracker([0, 1, 2, 3], weights={0: 3})
+    assert tracker.quorum == 4
+    assert tracker.update(1, 5) == -1
+    assert tracker.update(0, 3) == 3
+    assert tracker.update(2, 7) == 3
+    assert tracker.update(0, 9) == 7
+    assert tracker.update(3, 9) == 9
+    # A quorum must be more than half the total weight
+    for size in [ 2, 3 ]:
+        try:
+            QuorumTracker([0, 1, 2, 3], weights={0: 3}, quorum=size)
+            assert False, 'Expected AssertionError'
+        except AssertionError as e:
+            assert 'half' in str(e)
+
+def test_weighted_election(monkeypatch):
+    # Votes are weighted the same as commits.  With server 0 at weight 3,
+    # servers 2, 3 and 4 aren't a quorum (3 of 7)
+    from . import machine as machine_module
+    monkeypatch.setattr(machine_module, 'QUORUM_WEIGHTS', {0: 3})
+    control = MockRaftController(2, NSERVERS)
+    machine = RaftMachine(control)
+    machine.handle_ElectionTimeout()
+    for source in [3, 4, 4]:
+        machine.handle_Message(RequestVoteResponse(source=source, dest=2, term=1, voteGranted=True))
+    assert machine.state == Candidate
+    machine.handle_Message(RequestVoteResponse(source=0, dest=2, term=1, voteGranted=True))
+    assert machine.state == Leader
+
+
+def test_async_cluster(tmp_path, monkeypatch):
+    # Three servers sharing one event loop
+    monkeypatch.chdir(tmp_path)
+    async def main():
+        loop = asyncio.get_running_loop()
+        dispatch = AsyncQueueDispatcher(3)
+        servers = [ AsyncRaftController(i, dispatch, RaftMachine(), loop) for i in range(3) ]
+        for server in servers:
+            server.start()
+        servers[0].post(('handle_ElectionTimeout',))
+        while servers[0].machine.state is not Leader:
+            await asyncio.sleep(0.01)
+        await asyncio.wrap_future(servers[0].append_entry('x'))
+        assert servers[0].machine.log[-1].entry == 'x'
+        while any(server.machine.lastApplied < 0 for server in servers):
+            await asyncio.sleep(0.01)
+        for server in servers:
+            server.stop()
+    asyncio.run(asyncio.wait_for(main(), 2))
+
+def test_timer_service():
+    service = TimerService()
+    fired = []
+    t1 = service.call_later(0.05, fired.append, 1)
+    service.call_later(0.02, fired.append, 2)
+    service.call_later(0.01, fired.append, 3)
+    t1.cancel()
+    service.call_later(0.03, fired.append, 4)
+    time.sleep(0.1)
+    assert fired == [3, 2, 4]
+
+def test_debug_log(tmp_path):
+    text = debuglog.DebugLog(str(tmp_path / 'text'), 'debug')
+    text.debug('%s: send_message(%s)', 0, 'msg')
+    text.close()
+    assert open(tmp_path / 'text.txt').read().endswith('DEBUG 0: send_message(msg)\n')
+
+    binary = debuglog.DebugLog(str(tmp_path / 'bin'), 'info', binary=True)
+    binary.debug('skipped')
+    binary.info('Restoring snapshot (%d bytes)', 10)
+    binary.close()
+    records = list(debuglog.read_binary_log(tmp_path / 'bin.bin'))
+    assert [ r[1:] for r in records ] == [ (debuglog.INFO, 'Restoring snapshot (%d bytes)', (10,)) ]
+
+    # Nothing is written (or opened) when logging is off
+    off = debuglog.DebugLog(str(tmp_path / 'off'), 'off')
+    off.info('skipped')
+    off.close()
+    assert not (tmp_path / 'off.txt').exists()
+
+def test_async_kv_client(monkeypatch):
+    # Two fake servers.  Server 0 redirects everything to server 1.
+    # Server 1 answers 'get' and 'set' and never answers 'hang' or 'mset'
+    from . import aiokvclient
+    from .aiodispatcher import recv_frame, send_frame
+    import pickle
+    store = { }
+    sessions = [ ]
+    async def serve(leader, reader, writer):
+        send_frame(writer, pickle.dumps('ok' if leader else ('follower', 1)))
+        try:
+            while True:
+                req_id, name, args, *session = pickle.loads(await recv_frame(reader))
+                if not leader:
+                    send_frame(writer, pickle.dumps((req_id, 'redirect', 1)))
+                elif name == 'set':
+                    sessions.append(session[0])
+                    store[args[0]] = args[1]
+                    send_frame(writer, pickle.dumps((req_id, 'ok', len(store))))
+                elif name == 'get':
+                    send_frame(writer, pickle.dumps((req_id, 'ok', store.get(args[0]))))
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    async def main():
+        servers = [ await asyncio.start_server(lambda r, w, leader=leader: serve(leader, r, w), 'localhost', 0)
+                    for leader in (False, True) ]
+        monkeypatch.setattr(aiokvclient, 'KV_SERVER_CONFIG',
+                            [ server.sockets[0].getsockname()[:2] for server in servers ])
+        client = aiokvclient.AsyncKVClient(pool_size=2, timeout=0.5)
+        assert await client.set('x', 42) == 1
+        assert client.leader == 1 and client.last_index == 1
+        await asyncio.gather(*[ client.set(f'k{n}', n) for n in range(100) ])
+        assert await asyncio.gather(*[ client.get(f'k{n}') for n in range(100) ]) == list(range(100))
+        assert len(client._pools[1]) == 2
+        try:
+            await client.command('hang', timeout=0.05)
+            assert False, 'Expected timeout'
+        except asyncio.TimeoutError:
+            pass
+        # A write that timed out may still be applied.  It stays unanswered
+        # and later writes don't acknowledge past it
+        try:
+            await client.command('mset', [ ('y', 1) ], timeout=0.05)
+            assert False, 'Expected timeout'
+        except asyncio.TimeoutError:
+            pass
+        assert client._unanswered == { 102 }
+        await client.set('z', 0)
+        assert sessions[-1] == (client.client_id, 103, 101)
+        client.close()
+        for server in servers:
+            server.close()
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+def test_kv_client_pipelining(monkeypatch):
+    # Server 0 answers two of three requests out of order and redirects
+    # the third to server 1.  Server 1 drops the first connection without
+    # answering.  The client resends the same request each time
+    from . import kvclient
+    import pickle, socket
+    received = [ ]
+    def fake_server(sock, handlers):
+        for handler in handlers:
+            client, _ = sock.accept()
+            with client:
+                ch = Channel(client)
+                ch.send(pickle.dumps('ok'))
+                handler(ch)
+    def server0(ch):
+        requests = [ pickle.loads(ch.recv()) for _ in range(3) ]
+        assert [ r[0] for r in requests ] == [ 0, 1, 2 ]
+        for req_id, status, result in [ (2, 'ok', 'C'), (0, 'ok', 'A'), (1, 'redirect', 1) ]:
+            ch.send(pickle.dumps((req_id, status, result)))
+        ch.sock.recv(1)        # Wait for the client to go
+    def drop(ch):
+        received.append(pickle.loads(ch.recv()))
+    def answer(ch):
+        request = pickle.loads(ch.recv())
+        received.append(request)
+        ch.send(pickle.dumps((request[0], 'ok', 7)))
+        ch.sock.recv(1)
+    socks = [ socket.create_server(('localhost', 0)) for _ in range(2) ]
+    monkeypatch.setattr(kvclient, 'KV_SERVER_CONFIG', [ sock.getsockname()[:2] for sock in socks ])
+    for sock, handlers in zip(socks, [ [server0], [drop, answer] ]):
+        threading.Thread(target=fake_server, args=(sock, handlers), daemon=True).start()
+
+    client = kvclient.KVClient()
+    futs = [ client.submit('get', 'a'), client.submit('set', 'b', 2), client.submit('get', 'c') ]
+    assert futs[0].result(1) == 'A' and futs[2].result(1) == 'C'
+    assert futs[1].result(2) == 7
+    assert client.leader == 1
+    write = (1, 'set', ('b', 2), (client.client_id, 1, 0))
+    assert received == [ write, write ]
+    assert not client._pending and not client._unanswered
+    client._disconnect(client.ch)
+    for sock in socks:
+        sock.close()
+
+def test_kv_client_submit_while_connecting(monkeypatch):
+    # One thread looks for the leader (none is up yet).  Other threads can
+    # still submit.  Everything goes out once the leader is found
+    from . import kvclient
+    import pickle, socket
+    sock = socket.socket()
+    sock.bind(('localhost', 0))      # Not listening.  Connections are refused
+    monkeypatch.setattr(kvclient, 'KV_SERVER_CONFIG', [ sock.getsockname()[:2] ])
+    monkeypatch.setattr(kvclient, 'KV_CONNECT_BACKOFF', 0.05)
+    client = kvclient.KVClient()
+    first = [ ]
+    threading.Thread(target=lambda: first.append(client.submit('get', 'a')), daemon=True).start()
+    while not client._connecting:
+        time.sleep(0.01)
+    start = time.time()
+    fut = client.submit('get', 'b')
+    assert time.time() - start < 0.05 and not fut.done()
+
+    sock.listen()
+    client_sock, _ = sock.accept()
+    with client_sock:
+        ch = Channel(client_sock)
+        ch.send(pickle.dumps('ok'))
+        for _ in range(2):
+            req_id, name, args = pickle.loads(ch.recv())
+            ch.send(pickle.dumps((req_id, 'ok', args[0].upper())))
+        assert fut.result(1) == 'B'
+        while not first:
+            time.sleep(0.01)
+        assert first[0].result(1) == 'A'
+        assert not client._connecting and client.leader == 0
+        client._disconnect(client.ch)
+    sock.close()
+
+def test_kv_batches():
+    kv = make_kv_server()
+    kv.apply_entries([ LogEntry(1, ('a', 1)),
+                       LogEntry(1, None),
+                       LogEntry(1, [ ('set', 'b', 2), ('set', 'c', 3) ]),
+                       LogEntry(1, [ ('delete', 'a'), ('delete', 'x') ]) ], 0)
+    assert kv.store.mget(['a', 'b', 'c']) == [None, 2, 3]
+    assert not kv.needs_leader('mget', (['a'], 3, None))
+    assert kv.needs_leader('mset', ([('a', 1)],))
+
+def test_append_entry_futures(tmp_path, monkeypatch):
+    # Futures get the applicator's result for their entry.  They fail if
+    # the entry is replaced, covered by a snapshot, or if leadership is
+    # lost before it's applied
+    from .control import NotLeaderError
+    monkeypatch.chdir(tmp_path)
+    machine, control = test_election_successful()
+    controller = RaftController(0, QueueDispatcher(NSERVERS), machine,
+                                applicator=lambda entries, index: [ (index + n, e.entry)
+                                                                    for n, e in enumerate(entries) ])
+    futs = [ controller.append_entry(item) for item in 'abcd' ]
+    while not controller.event_queue.empty():
+        controller.handle_event(controller.event_queue.get())
+    assert [ fut.index for fut in futs ] == [ 0, 1, 2, 3 ]
+    for peer in [1, 2]:
+        machine.handle_Message(AppendEntriesResponse(source=peer, dest=0, term=1, success=True, matchIndex=0))
+    assert futs[0].result() == (0, 'a')
+    assert not futs[1].done()
+
+    machine.log.compact(1)
+    controller.restore_snapshot(b'')
+    assert str(futs[1].exception()) == 'Entry outcome unknown'
+    controller.apply_entries([ LogEntry(2, 'x') ], 2)
+    assert isinstance(futs[2].exception(), NotLeaderError)
+
+    # A new leader may never commit (or remove) the entry.  The future
+    # doesn't wait to find out
+    machine.handle_Message(
+        AppendEntries(source=1, dest=0, term=2, prevLogIndex=-1, prevLogTerm=-1, entries=[], leaderCommit=0)
+        )
+    assert machine.state == Follower
+    assert isinstance(futs[3].exception(), NotLeaderError)
+    assert not controller._pending
+
+def test_kv_unpipelined_timeout(monkeypatch):
+    # (name, args) requests are answered one at a time.  One that never
+    # completes times out instead of holding the connection forever
+    from . import kvserver
+    from concurrent.futures import Future
+    import pickle, socket
+    monkeypatch.setattr(kvserver, 'KV_REQUEST_TIMEOUT', 0.05)
+    kv = make_kv_server({ 'state': Leader, 'leaderId': 0 },
+                        append_entry=lambda entry: Future(), has_lease=lambda: True)
+    s1, s2 = socket.socketpair()
+    threading.Thread(target=kv.handle_client, args=(s1,), daemon=True).start()
+    ch = Channel(s2)
+    assert pickle.loads(ch.recv()) == 'ok'
+    ch.send(pickle.dumps(('set', ('a', 1))))
+    assert pickle.loads(ch.recv()) == ('error', 'Request timed out')
+    ch.send(pickle.dumps(('get', ('a',))))
+    assert pickle.loads(ch.recv()) == ('ok', None)
+    s2.close()
+
+def test_kv_sessions():
+    from .kvserver import KVStore
+    store = KVStore(session_ttl=100, max_sessions=2)
+    assert store.check_session('a', 1, 0, 10.0, 5) is None
+    assert store.check_session('a', 2, 0, 11.0, 6) is None
+    # Retries get the first result
+    assert store.check_session('a', 1, 0, 12.0, 7) == ('ok', 5)
+    assert store.check_session('a', 2, 1, 12.0, 8) == ('ok', 6)
+    assert store.check_session('a', 1, 1, 12.0, 9)[0] == 'error'
+    assert list(store.sessions['a'].results) == [2]
+
+    # Sessions go with the snapshot
+    copy = KVStore()
+    copy.restore(store.snapshot())
+    assert copy.check_session('a', 2, 1, 13.0, 10) == ('ok', 6)
+
+    # Least recently used beyond max_sessions, and idle longer than the ttl
+    store.check_session('b', 1, 0, 20.0, 11)
+    store.check_session('a', 3, 2, 21.0, 12)
+    store.check_session('c', 1, 0, 22.0, 13)
+    assert list(store.sessions) == ['a', 'c']
+    store.check_session('c', 2, 1, 150.0, 14)
+    assert list(store.sessions) == ['c']
+    assert store.check_session('a', 4, 3, 151.0, 15) == ('error', 'Session expired')
+
+def test_kv_write_outcome_unknown():
+    # Writes in a session whose outcome isn't known are sent back to the
+    # client to retry with the same seq.  Others can only fail
+    from .control import NotLeaderError
+    from concurrent.futures import Future
+    kv = make_kv_server({ 'leaderId': 2 })
+    fut = Future()
+    fut.set_exception(NotLeaderError('Entry outcome unknown'))
+    assert kv.write_result(fut, ('client', 1, 0)) == ('redirect', 2)
+    assert kv.write_result(fut) == ('error', 'Entry outcome unknown')
+
+def test_channel():
+    import socket
+    for binary in (False, True):
+        s1, s2 = socket.socketpair()
+        ch1 = Channel(s1, binary_header=binary)
+        ch2 = Channel(s2, binary_header=binary, bufsize=64)
+        msgs = [ b'x' * n for n in (0, 1, 30, 50, 64, 65, 1000, 7) ]
+        for msg in msgs:
+            ch1.send(msg)
+        assert [ ch2.recv() for msg in msgs ] == msgs
+        ch1.send_many(msgs)
+        ch1.send_many([ b'y' * 40000, b'z' ])
+        assert [ ch2.recv() for msg in msgs ] == msgs
+        assert [ ch2.recv(), ch2.recv() ] == [ b'y' * 40000, b'z' ]
+
+        # Compression.  Only of big messages
+        stats = collections.Counter()
+        ch1.send(b'compress:lzma,zlib')
+        ch2.accept_compression(['zlib'])
+        assert ch2.compression.name == 'zlib' and ch1.recv() == b'zlib'
+        accept = threading.Thread(target=ch1.accept_compression, args=(['zlib'],))
+        accept.start()
+        ch2.offer_compression(['zlib'], stats=stats)
+        accept.join()
+        for msg in [ b'small', b'y' * 40000, bytes(range(256)) * 20 ]:
+            ch2.send(msg)
+            assert ch1.recv() == msg
+        assert stats['messages'] == 2 and stats['compressed_bytes'] < stats['bytes']
+        ch1.send(b'z' * 5000)
+        assert ch2.recv() == b'z' * 5000
+        s1.close()
+        try:
+            ch2.recv()
+            assert False, 'Expected OSError'
+        except OSError:
+            pass
+        s2.close()
+
+def test_channel_limits():
+    # Messages can't be (or decompress to) more than a set size
+    from .channel import Compression, pack_header, unpack_header
+    from .config import CHANNEL_MAX_MESSAGE
+    import zlib, lzma
+    data = b'\0' * 100000
+    for name, compress in [ ('zlib', zlib.compress), ('lzma', lzma.compress) ]:
+        comp = Compression(name)
+        assert comp.decompress(compress(data), len(data)) == data
+        for bad, max_size in [ (compress(data), len(data) - 1),
+                               (compress(data)[:-8], len(data)),
+                               (b'garbage', len(data)) ]:
+            try:
+                comp.decompress(bad, max_size)
+                assert False, 'Expected OSError'
+            except OSError:
+                pass
+    import socket
+    for binary in (False, True):
+        assert unpack_header(pack_header(CHANNEL_MAX_MESSAGE, binary), binary) == (CHANNEL_MAX_MESSAGE, False)
+        s1, s2 = socket.socketpair()
+        s1.sendall(pack_header(CHANNEL_MAX_MESSAGE + 1, binary))
+        for recv in [ lambda: unpack_header(pack_header(CHANNEL_MAX_MESSAGE + 1, binary), binary),
+                      Channel(s2, binary_header=binary).recv ]:
+            try:
+                recv()
+                assert False, 'Expected OSError'
+            except OSError:
+                pass
+        s1.close()
+        s2.close()
+
+def test_receiver_garbage():
+    # The receiver thread drops connections that send garbage instead of dying
+    from .dispatcher import ChannelDispatcher
+    from .channel import compression_offer, pack_header
+    import socket
+    dispatcher = ChannelDispatcher(0)
+    for data in [ b'not a size!!',
+                  pack_header(10) + b'compress:\xff',
+                  pack_header(len(compression_offer())) + compression_offer() + pack_header(3) + b'bad' ]:
+        s1, s2 = socket.socketpair()
+        s1.sendall(data)
+        dispatcher.raft_receiver(s2)
+        s1.close()
+    assert dispatcher._recv_queue.empty()
+
+def test_bulk_lane():
+    from .dispatcher import is_bulk
+    machine, control = test_election_successful()
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=-1)
+        )
+    del control.messages[:]
+    for item in ['a', 'b']:
+        machine.append_new_entry(item)
+    assert all(is_bulk(m) for m in control.messages)
+
+    # Heartbeats may overtake the entries in flight, so they go out at
+    # the last known match even with room in the window
+    del control.messages[:]
+    machine.handle_LeaderTimeout()
+    sent = [ (m.prevLogIndex, len(m.entries)) for m in control.messages if m.dest == 1 ]
+    assert sent == [ (-1, 0) ]
+    assert not any(is_bulk(m) for m in control.messages if m.dest == 1)
+    assert not is_bulk(AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=1))
+
+def test_send_queue():
+    from .dispatcher import SendQueue
+    def heartbeat(term, commit):
+        return AppendEntries(dest=1, term=term, prevLogIndex=-1, prevLogTerm=-1, entries=[], leaderCommit=commit)
+    entries = AppendEntries(dest=1, term=1, prevLogIndex=-1, prevLogTerm=-1,
+                            entries=[LogEntry(1, 'a')], leaderCommit=-1)
+    q = SendQueue(maxsize=3)
+    q.put(heartbeat(1, -1))
+    q.put(entries)
+    q.put(heartbeat(1, 0))           # Replaces the first heartbeat
+    assert [ m.leaderCommit for m in q.messages ] == [ -1, 0 ]
+    assert q.messages[0] is entries
+
+    # Messages that couldn't be sent go back in front, unless superseded
+    msgs = q.take(2)
+    q.put(heartbeat(1, 1))
+    q.requeue(msgs)
+    assert list(q.messages)[0] is entries and len(q.messages) == 2
+
+    # A new term drops everything older
+    q.put(RequestVote(dest=1, term=2, lastLogIndex=0, lastLogTerm=1))
+    assert [ m.term for m in q.messages ] == [ 2 ]
+    q.requeue([ entries ])
+    assert len(q.messages) == 1
+
+    # Full queues drop the oldest
+    for n in range(4):
+        q.put(RequestVoteResponse(dest=1, term=2, voteGranted=n))
+    assert [ m.voteGranted for m in q.messages ] == [ 1, 2, 3 ]
+    assert q.summary() == { 'superseded': 5, 'dropped': 2, 'queued': 3 }
+
+def test_send_queue_overflow():
+    # Follower 1 is slow.  Its lanes (SendQueues of 2 messages) overflow
+    # while entries keep being added.  Once it keeps up again, it gets
+    # every entry and the leader stays the leader.
+    from .dispatcher import SendQueue, is_bulk
+    machine, control = test_election_successful()
+    machine.handle_Message(
+        AppendEntriesResponse(source=1, dest=0, term=1, success=True, matchIndex=-1)
+        )
+    machine.maxAppendEntries = 1
+    follower = RaftMachine(MockRaftController(1, NSERVERS))
+    follower.term = 1
+    lanes = { False: SendQueue(maxsize=2), True: SendQueue(maxsize=2) }
+    def route():
+        for msg in control.messages:
+            if msg.dest == 1:
+                msg.source = 0
+                lanes[is_bulk(msg)].put(msg)
+        del control.messages[:]
+    for tick in range(8):
+        for n in range(5):
+            machine.append_new_entry(n)
+        machine.handle_LeaderTimeout()
+        route()
+        if tick < 3:
+            continue          # Nothing gets through
+        while any(lane.messages for lane in lanes.values()):
+            for lane in lanes.values():
+                for msg in lane.take(10):
+                    follower.handle_Message(msg)
+            for resp in follower.control.messages:
+                machine.handle_Message(resp)
+            del follower.control.messages[:]
+            route()
+    assert lanes[True].stats['dropped'] > 0
+    assert machine.state == Leader
+    assert len(follower.log) == len(machine.log) == 40
@@ -0,0 +1,101 @@
+# timers.py
+#
+# One thread running the timers of any number of controllers.
+#
+# Timers are kept in a heap ordered by deadline.  The thread sleeps until
+# the earliest deadline (or until an earlier timer is added) and runs the
+# callback.  Cancelling a timer just marks it.  Marked timers are skipped
+# when they reach the top of the heap, and the heap is rebuilt without
+# them if they make up more than half of it (followers reset their
+# election timer on every AppendEntries, so there are lots of them).
+#
+# Callbacks run in the timer thread and should be quick.  The controllers
+# just put an event on their queue.
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+class Timer:
+    __slots__ = ('deadline', 'func', 'args', 'service', 'cancelled')
+
+    def __init__(self, deadline, func, args, service):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.service = service
+        self.cancelled = False
+
+    def cancel(self):
+        self.service._cancel(self)
+
+class TimerService:
+    def __init__(self):
+        self._heap = [ ]            # (deadline, seq, Timer)
+        self._seq = itertools.count()
+        self._ncancelled = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_at(self, deadline, func, *args):
+        # Run func(*args) at time.monotonic() deadline.  Returns a Timer
+        timer = Timer(deadline, func, args, self)
+        with self._cond:
+            if not self._thread:
+                # Started by the first timer
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(time.monotonic() + delay, func, *args)
+
+    def _cancel(self, timer):
+        with self._cond:
+            if not timer.cancelled:
+                timer.cancelled = True
+                self._ncancelled += 1
+                if self._ncancelled > len(self._heap) // 2:
+                    self._heap = [ item for item in self._heap if not item[2].cancelled ]
+                    heapq.heapify(self._heap)
+                    self._ncancelled = 0
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._ncancelled -= 1
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, _, timer = heapq.heappop(self._heap)
+                # Counts as cancelled from here on so cancel() does nothing
+                timer.cancelled = True
+                self._cond.release()
+                try:
+                    timer.func(*timer.args)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    self._cond.acquire()
+
+_timer_service = None
+_lock = threading.Lock()
+
+def get_timer_service():
+    # The timer service shared by all controllers in the process
+    global _timer_service
+    with _lock:
+        if _timer_service is None:
+            _timer_service = TimerService()
+        return _timer_service